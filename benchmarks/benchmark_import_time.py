@@ -0,0 +1,72 @@
+"""
+Check the time MAP Client takes to register this plugin is within budget.
+
+Imports the plugin package in a fresh interpreter after MAP Client and Qt are loaded, as happens
+during plugin discovery, and fails if it takes longer than the budget or loads zinc or scaffoldfitter.
+Exits with status 1 on failure so it can be run in CI.
+
+Usage:
+    python benchmarks/benchmark_import_time.py [--budget MILLISECONDS] [--repeat N]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+REPOSITORY_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules only needed once the step is executed.
+DEFERRED_MODULES = ['cmlibs.zinc', 'scaffoldfitter', 'mapclientplugins.organinserterstep.organinsertermodel']
+
+MEASURE_SCRIPT = """
+import json, sys, time
+import mapclient.mountpoints.workflowstep
+from PySide6 import QtCore, QtGui, QtWidgets
+import mapclientplugins
+start = time.perf_counter()
+import mapclientplugins.organinserterstep
+elapsed = time.perf_counter() - start
+print(json.dumps({
+    'elapsed': elapsed,
+    'registered': 'mapclientplugins.organinserterstep.step' in sys.modules,
+    'deferred_loaded': [name for name in %r if name in sys.modules],
+}))
+""" % (DEFERRED_MODULES,)
+
+
+def measure_import():
+    """
+    :return: dict with elapsed import time in seconds, whether the step was registered, and any deferred
+        modules which were loaded.
+    """
+    environment = dict(os.environ)
+    environment['PYTHONPATH'] = os.pathsep.join(filter(None, [REPOSITORY_DIRECTORY, environment.get('PYTHONPATH')]))
+    output = subprocess.check_output([sys.executable, '-c', MEASURE_SCRIPT], env=environment,
+                                     cwd=REPOSITORY_DIRECTORY)
+    return json.loads(output.decode().strip().split('\n')[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--budget', type=float, default=50.0, help='Maximum import time in milliseconds')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of times to repeat the measurement')
+    args = parser.parse_args()
+
+    results = [measure_import() for _ in range(args.repeat)]
+    best = min(result['elapsed'] for result in results) * 1000.0
+    print('plugin import: {:.1f} ms (budget {:.1f} ms)'.format(best, args.budget))
+    failures = []
+    if not results[-1]['registered']:
+        failures.append('step was not registered')
+    if results[-1]['deferred_loaded']:
+        failures.append('modules loaded on import: ' + ', '.join(results[-1]['deferred_loaded']))
+    if best > args.budget:
+        failures.append('import time over budget')
+    for failure in failures:
+        print('FAILED: ' + failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""
+Compare batched marker coordinate extraction in MarkerCoordinates against the per-node loop it replaced.
+
+Usage:
+    python benchmarks/benchmark_marker_coordinates.py [--markers N] [--elements N] [--repeat N]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from cmlibs.utils.zinc.field import findOrCreateFieldCoordinates, findOrCreateFieldGroup, \
+    findOrCreateFieldStoredString
+from cmlibs.utils.zinc.general import ChangeManager
+from cmlibs.zinc.field import Field
+from cmlibs.zinc.node import Node
+from cmlibs.zinc.result import RESULT_OK
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.synthetic_scaffolds import write_whole_body_scaffold  # noqa: E402
+from mapclientplugins.organinserterstep.organinsertermodel import MarkerCoordinates  # noqa: E402
+
+
+class PerNodeMarkerCoordinates(MarkerCoordinates):
+    """
+    MarkerCoordinates using the original per-node loop, creating an embedded field per marker group
+    and building the marker nodes one at a time.
+    """
+
+    def _get_marker_coordinates(self):
+        field_cache = self._field_module.createFieldcache()
+        nodes = self._field_module.findNodesetByFieldDomainType(Field.DOMAIN_TYPE_NODES)
+        marker_location_name, marker_name, marker_group_names = self.get_marker_fields()
+        markerLocation = self._field_module.findFieldByName(marker_location_name)
+        markerName = self._field_module.findFieldByName(marker_name)
+
+        marker_region = self._region.createRegion()
+        marker_fieldmodule = marker_region.getFieldmodule()
+        temp_nodes = marker_fieldmodule.findNodesetByFieldDomainType(Field.DOMAIN_TYPE_NODES)
+        marker_fieldCache = marker_fieldmodule.createFieldcache()
+        marker_data_coordinates = findOrCreateFieldCoordinates(marker_fieldmodule, name="marker_data_coordinates",
+                                                               components_count=3)
+        marker_data_name = findOrCreateFieldStoredString(marker_fieldmodule, name="marker_data_name")
+        marker_data_group = findOrCreateFieldGroup(marker_fieldmodule, name="marker")
+        marker_data_nodesGroup = marker_data_group.createNodesetGroup(temp_nodes)
+        markerTemplateInternal = temp_nodes.createNodetemplate()
+        markerTemplateInternal.defineField(marker_data_name)
+        markerTemplateInternal.defineField(marker_data_coordinates)
+        markerTemplateInternal.setValueNumberOfVersions(marker_data_coordinates, -1, Node.VALUE_LABEL_VALUE, 1)
+
+        for marker_group_name in marker_group_names:
+            markerGroup = self._field_module.findFieldByName(marker_group_name)
+            markerNodes = None
+            if markerGroup.isValid():
+                markerGroup = markerGroup.castGroup()
+                markerNodes = markerGroup.getNodesetGroup(nodes)
+            if markerLocation.isValid() and markerName.isValid():
+                with ChangeManager(marker_fieldmodule):
+                    marker_coordinates = self._field_module.createFieldEmbedded(self._model_coordinates_field,
+                                                                                markerLocation)
+                    nodeIter = markerNodes.createNodeiterator()
+                    node = nodeIter.next()
+                    while node.isValid():
+                        marker_node = temp_nodes.createNode(node.getIdentifier(), markerTemplateInternal)
+                        marker_data_nodesGroup.addNode(marker_node)
+                        marker_fieldCache.setNode(marker_node)
+                        field_cache.setNode(node)
+                        result, x = marker_coordinates.evaluateReal(field_cache, 3)
+                        result = marker_data_coordinates.setNodeParameters(marker_fieldCache, -1,
+                                                                           Node.VALUE_LABEL_VALUE, 1, x)
+                        if result == RESULT_OK:
+                            name = markerName.evaluateString(field_cache)
+                            if name:
+                                marker_data_name.assignString(marker_fieldCache, name)
+                        node = nodeIter.next()
+
+
+def time_marker_extraction(marker_coordinates_class, scaffold_file, repeat):
+    """
+    :return: Best time in seconds to extract markers, not including reading the scaffold file,
+        and the marker coordinates object from the last run.
+    """
+    times = []
+
+    class TimedMarkerCoordinates(marker_coordinates_class):
+
+        def _get_marker_coordinates(self):
+            start = time.perf_counter()
+            super()._get_marker_coordinates()
+            times.append(time.perf_counter() - start)
+
+    marker_coordinates = None
+    for _ in range(repeat):
+        marker_coordinates = TimedMarkerCoordinates(scaffold_file)
+    return min(times), marker_coordinates
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--markers', type=int, default=10000, help='Number of markers in the whole body')
+    parser.add_argument('--elements', type=int, default=10, help='Elements along each side of the whole body')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of times to repeat each measurement')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        scaffold_file = os.path.join(directory, 'whole_body.exf')
+        write_whole_body_scaffold(scaffold_file, args.elements, args.markers)
+        per_node_time, _ = time_marker_extraction(PerNodeMarkerCoordinates, scaffold_file, args.repeat)
+        batched_time, marker_coordinates = time_marker_extraction(MarkerCoordinates, scaffold_file, args.repeat)
+    assert len(marker_coordinates.marker_data()) == args.markers
+
+    print('markers: {}'.format(args.markers))
+    print('per-node loop: {:.4f} s'.format(per_node_time))
+    print('batched:       {:.4f} s ({:.1f}x)'.format(batched_time, per_node_time / batched_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+"""
+Benchmark each stage of the organ insertion pipeline on synthetic scaffolds.
+
+Records wall time, peak resident memory and bytes read and written for extracting marker
+coordinates from the whole body, and for loading, aligning, fitting and writing each organ.
+Results are written as JSON for tracking regressions between releases.
+Runs headless without Qt; memory and I/O measurements need Linux /proc.
+
+Usage:
+    python benchmarks/benchmark_organinserter.py [--organs N] [--organ-elements N] [--body-elements N]
+        [--markers N] [--organ-markers N] [--output FILE]
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.synthetic_scaffolds import marker_names, write_organ_scaffold, \
+    write_whole_body_scaffold  # noqa: E402
+from mapclientplugins.organinserterstep import __version__  # noqa: E402
+from mapclientplugins.organinserterstep import organinsertermodel  # noqa: E402
+from mapclientplugins.organinserterstep.organinsertermodel import MarkerCoordinates, \
+    OrganInserter, OrganTransformer  # noqa: E402
+
+
+def _read_proc_values(filename, keys):
+    """
+    :return: dict key -> int value for lines 'key: value ...' in /proc file, or None if unavailable.
+    """
+    try:
+        with open(filename) as f:
+            values = {}
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in keys:
+                    values[key] = int(value.split()[0])
+            return values
+    except OSError:
+        return None
+
+
+def _reset_peak_rss():
+    # Writing 5 to clear_refs resets the peak resident set size (VmHWM) on Linux.
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+class StageMeter(object):
+    """
+    Context manager recording wall time, peak RSS and bytes read and written over a pipeline stage.
+    Meters may be nested: each resets the peak RSS on entry, so enclosing meters take the maximum of their own
+    peak and the peaks of the meters nested in them.
+    """
+    # meters currently entered, outermost first
+    _active = []
+
+    def __init__(self, results, stage, organ=None):
+        self._results = results
+        self._stage = stage
+        self._organ = organ
+        self._start_time = None
+        self._start_io = None
+        self._nested_peak_rss = None
+
+    def __enter__(self):
+        _reset_peak_rss()
+        StageMeter._active.append(self)
+        self._start_io = _read_proc_values('/proc/self/io', ('rchar', 'wchar'))
+        self._start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall_time = time.perf_counter() - self._start_time
+        io = _read_proc_values('/proc/self/io', ('rchar', 'wchar'))
+        memory = _read_proc_values('/proc/self/status', ('VmHWM',))
+        peak_rss = memory['VmHWM'] * 1024 if memory else None
+        if (peak_rss is not None) and (self._nested_peak_rss is not None):
+            peak_rss = max(peak_rss, self._nested_peak_rss)
+        StageMeter._active.remove(self)
+        if peak_rss is not None:
+            for meter in StageMeter._active:
+                meter._nested_peak_rss = peak_rss if meter._nested_peak_rss is None else \
+                    max(meter._nested_peak_rss, peak_rss)
+        self._results.append({
+            'stage': self._stage,
+            'organ': self._organ,
+            'wall_time': wall_time,
+            'peak_rss': peak_rss,
+            'bytes_read': (io['rchar'] - self._start_io['rchar']) if (io and self._start_io) else None,
+            'bytes_written': (io['wchar'] - self._start_io['wchar']) if (io and self._start_io) else None,
+        })
+        return False
+
+
+def install_stage_meters(results):
+    """
+    Wrap the stages of MarkerCoordinates and OrganTransformer used by OrganInserter to record measurements.
+    """
+    marker_coordinates_init = MarkerCoordinates.__init__
+
+    def measured_marker_coordinates_init(self, *args, **kwargs):
+        with StageMeter(results, 'marker coordinates'):
+            marker_coordinates_init(self, *args, **kwargs)
+
+    MarkerCoordinates.__init__ = measured_marker_coordinates_init
+
+    def measure_method(method_name, stage):
+        method = getattr(OrganTransformer, method_name)
+
+        def measured_method(self, *args, **kwargs):
+            with StageMeter(results, stage, os.path.basename(self._output_filename).split('_transformed')[0]):
+                return method(self, *args, **kwargs)
+
+        setattr(OrganTransformer, method_name, measured_method)
+
+    measure_method('_load', 'load')
+    measure_method('_align', 'align')
+    measure_method('_fit', 'fit')
+    measure_method('_write_fitted_model', 'add organ group and write')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--organs', type=int, default=3, help='Number of organs to insert')
+    parser.add_argument('--organ-elements', type=int, default=6, help='Elements along each side of each organ')
+    parser.add_argument('--body-elements', type=int, default=12, help='Elements along each side of the whole body')
+    parser.add_argument('--markers', type=int, default=1000, help='Number of markers in the whole body')
+    parser.add_argument('--organ-markers', type=int, default=8, help='Number of markers in each organ')
+    parser.add_argument('--output', default='organinserter_benchmark.json', help='JSON file to write results to')
+    args = parser.parse_args()
+    assert 3 <= args.organ_markers <= args.markers, 'Need at least 3 organ markers, and no more than in the body'
+
+    results = []
+    install_stage_meters(results)
+    with tempfile.TemporaryDirectory() as directory:
+        whole_body_file = os.path.join(directory, 'whole_body.exf')
+        write_whole_body_scaffold(whole_body_file, args.body_elements, args.markers)
+        names = marker_names(args.markers)
+        organ_files = []
+        for i in range(args.organs):
+            organ_file = os.path.join(directory, 'organ{}.exf'.format(i + 1))
+            start = (i * args.organ_markers) % (args.markers - args.organ_markers + 1)
+            write_organ_scaffold(organ_file, args.organ_elements, names[start:start + args.organ_markers], i)
+            organ_files.append(organ_file)
+        output_directory = os.path.join(directory, 'output')
+        os.makedirs(output_directory)
+        with StageMeter(results, 'total'):
+            organ_inserter = OrganInserter(whole_body_file, organ_files, output_directory)
+    assert not organ_inserter.get_errors(), organ_inserter.get_errors()
+
+    report = {
+        'organinserterstep_version': __version__,
+        'python_version': platform.python_version(),
+        'platform': platform.platform(),
+        'zinc_version': organinsertermodel.Context('version').getVersionString(),
+        'parameters': vars(args),
+        'stages': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=4)
+
+    for result in results:
+        print('{:<28}{:<10}{:>10.3f} s{:>10.1f} MB'.format(
+            result['stage'], result['organ'] or '', result['wall_time'],
+            (result['peak_rss'] or 0) / (1024 * 1024)))
+    print('Results written to ' + args.output)
+
+
+if __name__ == '__main__':
+    main()
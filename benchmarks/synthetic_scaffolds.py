@@ -0,0 +1,112 @@
+"""
+Generate synthetic whole-body and organ scaffolds for benchmarking.
+
+Scaffolds are boxes of trilinear Lagrange elements with a 'coordinates' field. Markers are
+nodes with 'marker_location' and 'marker_name' fields in a marker group, as in scaffoldmaker
+output. Organs share marker names with the whole body so they can be fitted to it.
+"""
+import random
+
+from cmlibs.utils.zinc.field import find_or_create_field_coordinates, find_or_create_field_group, \
+    find_or_create_field_stored_mesh_location, find_or_create_field_stored_string
+from cmlibs.utils.zinc.general import ChangeManager
+from cmlibs.zinc.context import Context
+from cmlibs.zinc.element import Element, Elementbasis
+from cmlibs.zinc.field import Field
+from cmlibs.zinc.result import RESULT_OK
+
+# Marker group name found by MarkerCoordinates in whole-body scaffolds, and by the fitter in organs.
+WHOLE_BODY_MARKER_GROUP_NAME = 'body_marker'
+ORGAN_MARKER_GROUP_NAME = 'marker'
+
+
+def marker_names(count, prefix='marker'):
+    return ['{} {}'.format(prefix, i + 1) for i in range(count)]
+
+
+def write_box_scaffold(filename, elements_count, size, offset, marker_group_name, names, seed=0):
+    """
+    Write a cube scaffold of elements_count^3 elements with markers at random locations.
+
+    :param filename: Name of EX file to write.
+    :param elements_count: Number of elements along each side of the cube.
+    :param size: Length of each side of the cube.
+    :param offset: [x, y, z] of the minimum corner of the cube.
+    :param marker_group_name: Name of the group containing the marker nodes.
+    :param names: Names of the markers to add.
+    :param seed: Seed for random marker locations.
+    """
+    rng = random.Random(seed)
+    context = Context('synthetic')
+    region = context.createRegion()
+    field_module = region.getFieldmodule()
+    with ChangeManager(field_module):
+        coordinates = find_or_create_field_coordinates(field_module)
+        nodes = field_module.findNodesetByFieldDomainType(Field.DOMAIN_TYPE_NODES)
+        mesh = field_module.findMeshByDimension(3)
+        field_cache = field_module.createFieldcache()
+
+        node_template = nodes.createNodetemplate()
+        node_template.defineField(coordinates)
+        nodes_count = elements_count + 1
+        for k in range(nodes_count):
+            for j in range(nodes_count):
+                for i in range(nodes_count):
+                    node = nodes.createNode(1 + i + nodes_count * (j + nodes_count * k), node_template)
+                    field_cache.setNode(node)
+                    coordinates.assignReal(field_cache, [offset[0] + size * i / elements_count,
+                                                         offset[1] + size * j / elements_count,
+                                                         offset[2] + size * k / elements_count])
+
+        element_template = mesh.createElementtemplate()
+        element_template.setElementShapeType(Element.SHAPE_TYPE_CUBE)
+        basis = field_module.createElementbasis(3, Elementbasis.FUNCTION_TYPE_LINEAR_LAGRANGE)
+        eft = mesh.createElementfieldtemplate(basis)
+        element_template.defineField(coordinates, -1, eft)
+        for k in range(elements_count):
+            for j in range(elements_count):
+                for i in range(elements_count):
+                    base = 1 + i + nodes_count * (j + nodes_count * k)
+                    element = mesh.createElement(-1, element_template)
+                    element.setNodesByIdentifier(eft, [
+                        base + di + nodes_count * (dj + nodes_count * dk)
+                        for dk in range(2) for dj in range(2) for di in range(2)])
+        field_module.defineAllFaces()
+
+        marker_group = find_or_create_field_group(field_module, marker_group_name)
+        marker_location = find_or_create_field_stored_mesh_location(field_module, mesh, name='marker_location')
+        marker_name = find_or_create_field_stored_string(field_module, name='marker_name')
+        marker_nodes = marker_group.getOrCreateNodesetGroup(nodes)
+        marker_template = nodes.createNodetemplate()
+        marker_template.defineField(marker_location)
+        marker_template.defineField(marker_name)
+        node_identifier = nodes_count ** 3 + 1
+        elements_total = mesh.getSize()
+        for name in names:
+            node = nodes.createNode(node_identifier, marker_template)
+            node_identifier += 1
+            marker_nodes.addNode(node)
+            field_cache.setNode(node)
+            element = mesh.findElementByIdentifier(rng.randint(1, elements_total))
+            marker_location.assignMeshLocation(field_cache, element, [rng.random(), rng.random(), rng.random()])
+            marker_name.assignString(field_cache, name)
+    result = region.writeFile(filename)
+    assert result == RESULT_OK, "Failed to write synthetic scaffold " + filename
+
+
+def write_whole_body_scaffold(filename, elements_count=8, marker_count=100, seed=0):
+    """
+    Write a synthetic whole-body scaffold with marker_count markers named as by marker_names().
+    """
+    write_box_scaffold(filename, elements_count, 100.0, [0.0, 0.0, 0.0], WHOLE_BODY_MARKER_GROUP_NAME,
+                       marker_names(marker_count), seed)
+
+
+def write_organ_scaffold(filename, elements_count=4, names=None, seed=0):
+    """
+    Write a synthetic organ scaffold away from the whole body so it must be moved to fit.
+
+    :param names: Names of whole-body markers to also place in the organ; at least 3 are needed to align.
+    """
+    write_box_scaffold(filename, elements_count, 20.0, [200.0, -50.0, 30.0], ORGAN_MARKER_GROUP_NAME,
+                       names if names else marker_names(6), seed)
@@ -2,15 +2,19 @@
 """
 MAP Client Plugin
 """
+import sys
 
 __version__ = '0.1.1'
 __author__ = 'Elias Soltani'
 __stepname__ = 'organinserter'
 __location__ = ''
 
-# import class that derives itself from the step mountpoint.
-from mapclientplugins.organinserterstep import step
+# Register the step only when loaded by MAP Client, so the organ inserter model
+# can be used without importing Qt, e.g. by the benchmarks.
+if 'mapclient' in sys.modules:
+    # import class that derives itself from the step mountpoint.
+    from mapclientplugins.organinserterstep import step
 
-# Import the resource file when the module is loaded,
-# this enables the framework to use the step icon.
-from . import resources_rc
\ No newline at end of file
+    # Import the resource file when the module is loaded,
+    # this enables the framework to use the step icon.
+    from . import resources_rc
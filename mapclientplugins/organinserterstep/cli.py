@@ -0,0 +1,165 @@
+"""
+Insert organs into whole-body scaffolds without the MAP Client GUI.
+
+Run a single subject:
+    organinserter --whole-body whole-body.exf --organ heart=heart.exf --organ lung=lung.exf --output-directory out
+
+or many subjects listed in a JSON manifest:
+    organinserter --manifest subjects.json
+
+The manifest holds a list of subjects, each with the whole-body scaffold, a mapping of organ name to organ
+scaffold file and the output directory. Relative paths are relative to the manifest file:
+    [
+        {"whole_body": "subject1/whole-body.exf",
+         "organs": {"heart": "subject1/heart.exf", "lung": "subject1/lung.exf"},
+         "output_directory": "subject1/output"},
+        ...
+    ]
+"""
+import argparse
+import json
+import os
+import sys
+
+from mapclientplugins.organinserterstep.organinsertermodel import OrganInserter
+from mapclientplugins.organinserterstep.organresultcache import OrganResultCache
+from mapclientplugins.organinserterstep.organtemplates import OrganTemplateLibrary
+
+
+def insert_organs(whole_body_file, organ_files, output_directory, number_of_workers=1, cache_directory=None,
+                  force_refit=False, write_profile=True, combined_output=False, fit_settings=None, preview=False,
+                  low_memory=False, resume=False, template_directory=None):
+    """
+    Insert organs into a whole-body scaffold, as the step does after Done is clicked.
+
+    :param whole_body_file: Whole-body scaffold file with embedded markers.
+    :param organ_files: dict organ name -> organ scaffold file, or list of organ scaffold files whose organ
+        names are determined from their file names.
+    :param output_directory: Directory to write transformed organ files to. Created if it does not exist.
+    :param number_of_workers: Number of worker processes to transform organs in.
+    :param cache_directory: Optional directory to cache transformed organs in.
+    :param force_refit: Set to True to transform organs even if they are in the cache.
+    :param write_profile: Set to True to write organinserter_profile.json in output_directory.
+    :param combined_output: Set to True to also write the whole body and all organs to one file.
+    :param fit_settings: Optional dict of fit settings overriding DEFAULT_FIT_SETTINGS.
+    :param preview: Set to True to only align organs, also writing each organ's transform as JSON.
+    :param low_memory: Set to True to transform each organ in its own process to bound memory use.
+    :param resume: Set to True to resume from the journal of an interrupted run in output_directory.
+    :param template_directory: Optional directory of organ templates to warm-start fits with the warm_start fit
+        setting from, updated with each fit.
+    :return: OrganInserter with output file names and errors.
+    """
+    if isinstance(organ_files, dict):
+        organ_names = {organ_file: organ for organ, organ_file in organ_files.items()}
+        input_files = list(organ_files.values())
+    else:
+        organ_names = None
+        input_files = list(organ_files)
+    os.makedirs(output_directory, exist_ok=True)
+    cache = OrganResultCache(cache_directory, force_refit=force_refit) if cache_directory else None
+    templates = OrganTemplateLibrary(template_directory) if template_directory else None
+    return OrganInserter(whole_body_file, input_files, output_directory, number_of_workers=number_of_workers,
+                         cache=cache, write_profile=write_profile, combined_output=combined_output,
+                         fit_settings=fit_settings, preview=preview, low_memory=low_memory,
+                         journal=True, resume=resume, templates=templates, organ_names=organ_names)
+
+
+def read_manifest(filename):
+    """
+    Read subjects from a JSON manifest, resolving paths relative to the manifest file.
+
+    :return: List of dicts with keys whole_body, organs, output_directory.
+    """
+    with open(filename) as f:
+        subjects = json.load(f)
+    base_directory = os.path.dirname(os.path.abspath(filename))
+
+    def resolve(path):
+        return os.path.join(base_directory, path)
+
+    manifest = []
+    for index, subject in enumerate(subjects):
+        for key in ('whole_body', 'organs', 'output_directory'):
+            if key not in subject:
+                raise ValueError("Subject {} in manifest {} is missing '{}'".format(index + 1, filename, key))
+        manifest.append({
+            'whole_body': resolve(subject['whole_body']),
+            'organs': {organ: resolve(organ_file) for organ, organ_file in subject['organs'].items()},
+            'output_directory': resolve(subject['output_directory']),
+        })
+    return manifest
+
+
+def _parse_organ(text):
+    organ, separator, organ_file = text.partition('=')
+    if not (separator and organ and organ_file):
+        raise argparse.ArgumentTypeError("Expected ORGAN=FILE, got '{}'".format(text))
+    return organ, organ_file
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='organinserter', description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--whole-body', help='Whole-body scaffold file with embedded markers')
+    parser.add_argument('--organ', type=_parse_organ, action='append', default=[], metavar='ORGAN=FILE',
+                        help='Organ name and scaffold file; may be repeated')
+    parser.add_argument('--output-directory', help='Directory to write transformed organ files to')
+    parser.add_argument('--manifest', help='JSON file listing subjects to process instead of a single subject')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes per subject')
+    parser.add_argument('--cache-directory', help='Directory to cache transformed organs in')
+    parser.add_argument('--force-refit', action='store_true', help='Transform organs even if cached')
+    parser.add_argument('--combined-output', action='store_true',
+                        help='Also write the whole body and all organs to one file, each organ in a child region')
+    parser.add_argument('--iterations', type=int, help='Number of fit iterations at full resolution')
+    parser.add_argument('--levels', type=int,
+                        help='Number of fit levels; levels before the last are stiffer pre-fits of the markers')
+    parser.add_argument('--level-iterations', type=int, help='Number of fit iterations on each pre-fit level')
+    parser.add_argument('--preview', action='store_true',
+                        help='Only align organs to the markers, also writing their 4x4 transforms as JSON')
+    parser.add_argument('--low-memory', action='store_true',
+                        help='Transform each organ in its own process, releasing its memory when done')
+    parser.add_argument('--resume', action='store_true',
+                        help='Resume interrupted runs, reusing organs completed with unchanged inputs and settings')
+    parser.add_argument('--template-directory',
+                        help='Warm-start each organ fit from its last fit for an earlier subject, keeping the '
+                             'fitted organs in this directory')
+    args = parser.parse_args(argv)
+
+    if args.manifest:
+        if args.whole_body or args.organ or args.output_directory:
+            parser.error('--manifest cannot be used with --whole-body, --organ or --output-directory')
+        subjects = read_manifest(args.manifest)
+    elif args.whole_body and args.organ and args.output_directory:
+        subjects = [{
+            'whole_body': args.whole_body,
+            'organs': dict(args.organ),
+            'output_directory': args.output_directory,
+        }]
+    else:
+        parser.error('either --manifest, or --whole-body, --organ and --output-directory are required')
+
+    fit_settings = {key: getattr(args, key) for key in ('iterations', 'levels', 'level_iterations')
+                    if getattr(args, key) is not None}
+    if args.template_directory:
+        fit_settings['warm_start'] = True
+    failed_count = 0
+    for index, subject in enumerate(subjects):
+        print("Subject {} of {}: {}".format(index + 1, len(subjects), subject['whole_body']))
+        try:
+            organ_inserter = insert_organs(subject['whole_body'], subject['organs'], subject['output_directory'],
+                                           number_of_workers=args.workers, cache_directory=args.cache_directory,
+                                           force_refit=args.force_refit, combined_output=args.combined_output,
+                                           fit_settings=fit_settings, preview=args.preview,
+                                           low_memory=args.low_memory, resume=args.resume,
+                                           template_directory=args.template_directory)
+        except Exception as e:
+            print("Failed to insert organs for {}: {}".format(subject['whole_body'], e))
+            failed_count += 1
+            continue
+        if organ_inserter.get_errors():
+            failed_count += 1
+    print("{} of {} subjects completed without errors".format(len(subjects) - failed_count, len(subjects)))
+    return 1 if failed_count else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,11 +1,15 @@
 
 
 from PySide6 import QtWidgets
+from mapclientplugins.organinserterstep.organfitsettings import get_fit_settings
+from mapclientplugins.organinserterstep.organregistry import get_organ_registry
 from mapclientplugins.organinserterstep.ui_configuredialog import Ui_ConfigureDialog
 
 INVALID_STYLE_SHEET = 'background-color: rgba(239, 0, 0, 50)'
 DEFAULT_STYLE_SHEET = ''
 
+DEFAULT_FIT_SETTINGS_ITEM = 'Default'
+
 
 class ConfigureDialog(QtWidgets.QDialog):
     """
@@ -26,10 +30,80 @@ class ConfigureDialog(QtWidgets.QDialog):
         # We will use this method to decide whether the identifier is unique.
         self.identifierOccursCount = None
 
+        # Default fit settings, and dict organ name -> fit settings for organs not using the defaults
+        self._fit_settings = get_fit_settings()
+        self._organ_fit_settings = {}
+        self._current_organ = None
+
         self._makeConnections()
 
     def _makeConnections(self):
         self._ui.lineEdit0.textChanged.connect(self.validate)
+        self._ui.comboBoxOrgan.currentTextChanged.connect(self._organChanged)
+        self._ui.checkBoxUseDefault.toggled.connect(self._useDefaultToggled)
+        self._ui.checkBoxFit.toggled.connect(self._updateFitSettingsEnabled)
+
+    def _getFitSettingsWidgets(self):
+        return {
+            'strain_penalty': self._ui.doubleSpinBoxStrainPenalty,
+            'curvature_penalty': self._ui.doubleSpinBoxCurvaturePenalty,
+            'data_weight': self._ui.doubleSpinBoxDataWeight,
+            'iterations': self._ui.spinBoxIterations,
+            'levels': self._ui.spinBoxLevels,
+            'level_iterations': self._ui.spinBoxLevelIterations,
+            'tolerance': self._ui.doubleSpinBoxTolerance,
+        }
+
+    def _displayFitSettings(self, fit_settings):
+        self._ui.checkBoxFit.setChecked(fit_settings['fit'])
+        self._ui.checkBoxWarmStart.setChecked(fit_settings['warm_start'])
+        for key, widget in self._getFitSettingsWidgets().items():
+            widget.setValue(fit_settings[key])
+        self._updateFitSettingsEnabled()
+
+    def _readFitSettings(self):
+        fit_settings = {'fit': self._ui.checkBoxFit.isChecked(), 'warm_start': self._ui.checkBoxWarmStart.isChecked()}
+        for key, widget in self._getFitSettingsWidgets().items():
+            fit_settings[key] = widget.value()
+        return fit_settings
+
+    def _storeFitSettings(self):
+        """
+        Store the displayed fit settings for the current organ, or as the defaults.
+        """
+        if self._current_organ is None:
+            self._fit_settings.update(self._readFitSettings())
+        elif not self._ui.checkBoxUseDefault.isChecked():
+            self._organ_fit_settings[self._current_organ] = self._readFitSettings()
+
+    def _organChanged(self, text):
+        self._storeFitSettings()
+        self._showOrgan(text)
+
+    def _showOrgan(self, text):
+        organ = text.strip()
+        self._current_organ = None if (organ in ('', DEFAULT_FIT_SETTINGS_ITEM)) else organ
+        use_default = (self._current_organ is None) or (self._current_organ not in self._organ_fit_settings)
+        self._ui.checkBoxUseDefault.blockSignals(True)
+        self._ui.checkBoxUseDefault.setChecked(use_default)
+        self._ui.checkBoxUseDefault.setEnabled(self._current_organ is not None)
+        self._ui.checkBoxUseDefault.blockSignals(False)
+        self._displayFitSettings(get_fit_settings(self._fit_settings,
+                                                  self._organ_fit_settings.get(self._current_organ)))
+
+    def _useDefaultToggled(self, checked):
+        if checked:
+            self._organ_fit_settings.pop(self._current_organ, None)
+            self._displayFitSettings(self._fit_settings)
+        else:
+            self._organ_fit_settings[self._current_organ] = self._readFitSettings()
+        self._updateFitSettingsEnabled()
+
+    def _updateFitSettingsEnabled(self):
+        editable = (self._current_organ is None) or not self._ui.checkBoxUseDefault.isChecked()
+        self._ui.checkBoxFit.setEnabled(editable)
+        for widget in list(self._getFitSettingsWidgets().values()) + [self._ui.checkBoxWarmStart]:
+            widget.setEnabled(editable and self._ui.checkBoxFit.isChecked())
 
     def accept(self):
         """
@@ -39,7 +113,8 @@ class ConfigureDialog(QtWidgets.QDialog):
         result = QtWidgets.QMessageBox.Yes
         if not self.validate():
             result = QtWidgets.QMessageBox.warning(self, 'Invalid Configuration',
-                'This configuration is invalid.  Unpredictable behaviour may result if you choose \'Yes\', are you sure you want to save this configuration?)',
+                'This configuration is invalid.  Unpredictable behaviour may result if you choose \'Yes\', '
+                'are you sure you want to save this configuration?)',
                 QtWidgets.QMessageBox.Yes | QtWidgets.QMessageBox.No, QtWidgets.QMessageBox.No)
 
         if result == QtWidgets.QMessageBox.Yes:
@@ -71,6 +146,15 @@ class ConfigureDialog(QtWidgets.QDialog):
         self._previousIdentifier = self._ui.lineEdit0.text()
         config = {}
         config['identifier'] = self._ui.lineEdit0.text()
+        config['workers'] = self._ui.spinBoxWorkers.value()
+        config['force_refit'] = self._ui.checkBoxForceRefit.isChecked()
+        config['combined_output'] = self._ui.checkBoxCombinedOutput.isChecked()
+        config['preview'] = self._ui.checkBoxPreview.isChecked()
+        config['low_memory'] = self._ui.checkBoxLowMemory.isChecked()
+        self._storeFitSettings()
+        config['fit_settings'] = dict(self._fit_settings)
+        config['organ_fit_settings'] = {organ: dict(fit_settings)
+                                        for organ, fit_settings in self._organ_fit_settings.items()}
         return config
 
     def setConfig(self, config):
@@ -81,4 +165,22 @@ class ConfigureDialog(QtWidgets.QDialog):
         '''
         self._previousIdentifier = config['identifier']
         self._ui.lineEdit0.setText(config['identifier'])
+        self._ui.spinBoxWorkers.setValue(config.get('workers', 1))
+        self._ui.checkBoxForceRefit.setChecked(config.get('force_refit', False))
+        self._ui.checkBoxCombinedOutput.setChecked(config.get('combined_output', False))
+        self._ui.checkBoxPreview.setChecked(config.get('preview', False))
+        self._ui.checkBoxLowMemory.setChecked(config.get('low_memory', False))
+        self._fit_settings = get_fit_settings(config.get('fit_settings'))
+        self._organ_fit_settings = {organ: dict(fit_settings)
+                                    for organ, fit_settings in config.get('organ_fit_settings', {}).items()}
+        self._current_organ = None
+        self._ui.comboBoxOrgan.blockSignals(True)
+        self._ui.comboBoxOrgan.clear()
+        self._ui.comboBoxOrgan.addItem(DEFAULT_FIT_SETTINGS_ITEM)
+        organ_names = get_organ_registry().get_organ_names(fit_only=True)
+        for organ in organ_names + sorted(set(self._organ_fit_settings) - set(organ_names)):
+            self._ui.comboBoxOrgan.addItem(organ)
+        self._ui.comboBoxOrgan.setCurrentIndex(0)
+        self._ui.comboBoxOrgan.blockSignals(False)
+        self._showOrgan(DEFAULT_FIT_SETTINGS_ITEM)
 
@@ -0,0 +1,35 @@
+# Settings for fitting organs to the markers.
+# If fit is False the organ is only aligned to the markers.
+# With more than 1 level, the organ is first pre-fitted to the markers for level_iterations on each extra level,
+# with penalties scaled up by level_penalty_factor per level, then fitted with the settings above. Only markers are
+# fitted, so the stiffer pre-fit can help organs far from the markers converge but adds iterations rather than
+# saving time.
+# With tolerance > 0, iterations on each level stop early once the relative decrease in RMS error is below it.
+# With warm_start, the fit starts from the organ's template from a previous subject if there is one, and as it is
+# already close only the last level is fitted, with warm_start_iterations.
+DEFAULT_FIT_SETTINGS = {
+    'fit': True,
+    'strain_penalty': 0.001,
+    'curvature_penalty': 200.0,
+    'data_weight': 1000.0,
+    'iterations': 1,
+    'levels': 1,
+    'level_iterations': 1,
+    'level_penalty_factor': 10.0,
+    'tolerance': 0.0,
+    'warm_start': False,
+    'warm_start_iterations': 1,
+}
+
+
+def get_fit_settings(*fit_settings):
+    """
+    :param fit_settings: Any number of dicts of fit settings, or None, each overriding DEFAULT_FIT_SETTINGS
+        and the ones before it.
+    :return: Complete dict of fit settings.
+    """
+    settings = dict(DEFAULT_FIT_SETTINGS)
+    for overrides in fit_settings:
+        if overrides:
+            settings.update(overrides)
+    return settings
@@ -0,0 +1,203 @@
+"""
+Scan EX files for their regions, fields and groups, and count their nodes and elements, without reading them into
+zinc. Used to check inputs and estimate the cost of fitting organs before any fitting starts.
+"""
+import mmap
+import os
+import re
+
+# Lines starting sections or defining fields; node and element lines between them are counted separately.
+SECTION_PATTERN = re.compile(
+    rb'^[ \t]*(?:'
+    rb'Region:[ \t]*(?P<region>.*?)|'
+    rb'Group name:[ \t]*(?P<group>.*?)|'
+    rb'!#nodeset[ \t]+(?P<nodeset>\w+).*?|'
+    rb'Shape\.[ \t]*Dimension=(?P<dimension>\d).*?|'
+    rb'\d+\)[ \t]*(?P<field>[^,\r\n]+?)[ \t]*,[ \t]*(?P<field_type>\w+)[ \t]*(?P<field_details>,.*?)?'
+    rb')[ \t\r]*$', re.MULTILINE)
+NODE_PATTERN = re.compile(rb'^[ \t]*Node:', re.MULTILINE)
+ELEMENT_PATTERN = re.compile(rb'^[ \t]*Element:', re.MULTILINE)
+COMPONENTS_PATTERN = re.compile(rb'#Components=(\d+)')
+# Lines giving the region, mesh and identifier of elements, and the lists of face and node identifiers following
+# them in EX version 3 files.
+ELEMENT_SECTION_PATTERN = re.compile(
+    rb'^[ \t]*(?:'
+    rb'Region:[ \t]*(?P<region>.*?)|'
+    rb'(?P<mesh>!#mesh[ \t]+.*?dimension=(?P<dimension>\d).*?)|'
+    rb'Element:[ \t]*(?P<element>\d+).*?|'
+    rb'(?P<list>Faces|Nodes):(?P<identifiers>(?:[ \t\r]*\n[ \t]*-?\d+(?:[ \t]+-?\d+)*)*)'
+    rb')[ \t\r]*$', re.MULTILINE)
+
+
+def scan_ex_file(filename):
+    """
+    Scan the headers of an EX file. Nodes and elements are counted each time they are listed, which is once in
+    files written by zinc.
+
+    :return: dict with 'size' in bytes, lists of 'regions' and 'groups' names, 'fields' dict name -> dict with
+        'type' (coordinate, field, ...), 'components' and 'details' (rest of the field header), 'nodes' and
+        'datapoints' counts, and 'elements' list of counts in 1, 2 and 3 dimensions.
+    """
+    summary = {
+        'size': os.path.getsize(filename),
+        'regions': [],
+        'groups': [],
+        'fields': {},
+        'nodes': 0,
+        'datapoints': 0,
+        'elements': [0, 0, 0],
+    }
+    if summary['size'] == 0:
+        return summary
+    with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as text:
+        nodeset = 'nodes'
+        dimension = 0
+        position = 0
+
+        def count(end):
+            if nodeset in ('nodes', 'datapoints'):
+                summary[nodeset] += len(NODE_PATTERN.findall(text, position, end))
+            if dimension > 0:
+                summary['elements'][dimension - 1] += len(ELEMENT_PATTERN.findall(text, position, end))
+
+        for match in SECTION_PATTERN.finditer(text):
+            count(match.start())
+            position = match.end()
+            if match.group('region') is not None:
+                summary['regions'].append(match.group('region').decode(errors='replace'))
+                nodeset = 'nodes'
+            elif match.group('group') is not None:
+                summary['groups'].append(match.group('group').decode(errors='replace'))
+            elif match.group('nodeset') is not None:
+                nodeset = match.group('nodeset').decode(errors='replace')
+            elif match.group('dimension') is not None:
+                dimension = min(int(match.group('dimension')), 3)
+            else:
+                details = match.group('field_details') or b''
+                components = COMPONENTS_PATTERN.search(details)
+                summary['fields'].setdefault(match.group('field').decode(errors='replace'), {
+                    'type': match.group('field_type').decode(errors='replace'),
+                    'components': int(components.group(1)) if components else 1,
+                    'details': details.decode(errors='replace').strip(', '),
+                })
+        count(len(text))
+    return summary
+
+
+def _format_identifier_ranges(identifiers):
+    """
+    :return: Sorted identifiers as comma separated ranges, e.g. 1..3,5,7..8, as written by zinc.
+    """
+    ranges = []
+    for identifier in sorted(identifiers):
+        if ranges and (identifier == ranges[-1][1] + 1):
+            ranges[-1][1] = identifier
+        else:
+            ranges.append([identifier, identifier])
+    return ','.join(str(first) if first == last else '{}..{}'.format(first, last) for first, last in ranges)
+
+
+def scan_ex_group_definition(filename, group_name):
+    """
+    Make the definition of a group of all 3D elements in an EX file with their faces and nodes, as zinc writes
+    it, by scanning the element identifiers and their face and node lists without reading the file into zinc.
+    Only EX version 3 files with a single region, as written by zinc, can be scanned.
+
+    :return: Group definition as bytes ending in a newline, to append to the file, or None if the file
+        cannot be scanned.
+    """
+    mesh_headers = {}
+    elements = [{}, {}, {}]
+    with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as text:
+        dimension = 0
+        element = None
+        for match in ELEMENT_SECTION_PATTERN.finditer(text):
+            if match.group('region') is not None:
+                if match.group('region').strip(b'/'):
+                    return None
+            elif match.group('mesh') is not None:
+                dimension = min(int(match.group('dimension')), 3)
+                mesh_headers.setdefault(dimension, match.group('mesh').decode(errors='replace'))
+                element = None
+            elif match.group('element') is not None:
+                if not dimension:
+                    return None
+                element = elements[dimension - 1].setdefault(int(match.group('element')), {})
+            elif element is not None:
+                element[match.group('list').decode()] = [int(identifier) for identifier in
+                                                         match.group('identifiers').split()]
+    if not elements[2]:
+        return None
+    # all 3D elements, their faces and faces of faces, and the nodes of all of these
+    group_elements = [set(), set(), set(elements[2])]
+    node_identifiers = set()
+    for dimension in (3, 2, 1):
+        for identifier in group_elements[dimension - 1]:
+            lists = elements[dimension - 1].get(identifier, {})
+            node_identifiers.update(lists.get('Nodes', ()))
+            if dimension > 1:
+                group_elements[dimension - 2].update(face for face in lists.get('Faces', ()) if face > 0)
+    lines = ['Group name: {}'.format(group_name)]
+    if node_identifiers:
+        lines += ['!#nodeset nodes', 'Node group:', _format_identifier_ranges(node_identifiers)]
+    for dimension in (1, 2, 3):
+        if group_elements[dimension - 1]:
+            if dimension not in mesh_headers:
+                return None
+            lines += [mesh_headers[dimension], 'Element group:',
+                      _format_identifier_ranges(group_elements[dimension - 1])]
+    return ('\n'.join(lines) + '\n').encode()
+
+
+def _has_coordinates(summary):
+    return any((field['type'] == 'coordinate') and (field['components'] == 3) and ('string' not in field['details'])
+               for field in summary['fields'].values())
+
+
+def _find_fields(summary, name_part, detail_part):
+    return [name for name, field in summary['fields'].items()
+            if (name_part in name.lower()) and (detail_part in field['details'])]
+
+
+def validate_whole_body(summary):
+    """
+    Check a whole-body scaffold scan has what is needed to evaluate its markers.
+
+    :param summary: dict returned by scan_ex_file().
+    :return: List of problems, empty if none found.
+    """
+    problems = []
+    if not any(summary['elements']):
+        problems.append('no elements')
+    if not _has_coordinates(summary):
+        problems.append('no 3-component coordinate field')
+    if not (_find_fields(summary, 'marker', 'element_xi') and _find_fields(summary, 'marker', 'string')):
+        problems.append('no marker location and name fields')
+    return problems
+
+
+def validate_organ(summary, fit=True):
+    """
+    Check an organ scaffold scan has what is needed to insert it.
+
+    :param summary: dict returned by scan_ex_file().
+    :param fit: Set to False for organs which are only grouped, not fitted to markers.
+    :return: List of problems, empty if none found.
+    """
+    problems = []
+    if not summary['elements'][2]:
+        problems.append('no 3D elements')
+    if fit:
+        if not _has_coordinates(summary):
+            problems.append('no 3-component coordinate field')
+        if 'marker' not in summary['groups']:
+            problems.append("no 'marker' group to align to the whole-body markers")
+    return problems
+
+
+def estimate_fit_cost(summary):
+    """
+    :param summary: dict returned by scan_ex_file().
+    :return: Relative cost of fitting the organ, from the number of nodes and elements being fitted.
+    """
+    return summary['nodes'] + sum(summary['elements'])
@@ -0,0 +1,148 @@
+"""
+Journal of the stages completed in an organ inserter run, kept in the output directory so that an interrupted
+run can be resumed without repeating completed work.
+"""
+import json
+import os
+
+from mapclientplugins.organinserterstep.organresultcache import hash_file
+
+JOURNAL_FILENAME = 'organinserter_journal.json'
+JOURNAL_MARKERS_FILENAME = 'organinserter_journal.markers'
+# Increment when the journal content changes so old journals are not resumed from.
+JOURNAL_FORMAT_VERSION = 1
+# Outputs are written to their name with this suffix then renamed when complete, so are never seen partly written.
+TEMPORARY_SUFFIX = '.tmp'
+
+
+def file_stamp(filename):
+    """
+    :return: [modification time in nanoseconds, size] of file, or None if it does not exist.
+    """
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def organ_fingerprint(organ_file, organ_name, fit_settings, preview=False, whole_body_fingerprint=None):
+    """
+    :return: Hex digest identifying the organ file content and the settings its output depends on.
+        Templates of warm-started fits are not included, as each fit replaces its template; only the
+        warm_start fit setting is.
+    """
+    hasher = hash_file(organ_file)
+    hasher.update(json.dumps([whole_body_fingerprint, organ_name, fit_settings, preview], sort_keys=True).encode())
+    return hasher.hexdigest()
+
+
+class OrganInserterJournal(object):
+    """
+    Records the marker data and each organ's completed stages and output, with fingerprints of the inputs.
+    The journal file is rewritten atomically after each change, and outputs are only recorded after they are
+    completely written, so after an interruption the journal only lists complete work.
+    """
+
+    def __init__(self, output_directory, whole_body_file, resume=False):
+        """
+        :param output_directory: Directory of the run's outputs, in which the journal is kept.
+        :param whole_body_file: Whole-body scaffold file of the run.
+        :param resume: Set to True to continue from the journal of a previous run in output_directory with the
+            same whole-body scaffold content. Otherwise any previous journal is replaced.
+        """
+        self._output_directory = output_directory
+        self._filename = os.path.join(output_directory, JOURNAL_FILENAME)
+        self._markers_filename = os.path.join(output_directory, JOURNAL_MARKERS_FILENAME)
+        self._whole_body_fingerprint = hash_file(whole_body_file).hexdigest()
+        self._journal = {
+            'version': JOURNAL_FORMAT_VERSION,
+            'whole_body': whole_body_file,
+            'whole_body_fingerprint': self._whole_body_fingerprint,
+            'markers': False,
+            'organs': {},
+        }
+        if resume:
+            previous = self._read()
+            if previous and (previous.get('version') == JOURNAL_FORMAT_VERSION) and \
+                    (previous.get('whole_body_fingerprint') == self._whole_body_fingerprint):
+                self._journal['markers'] = previous['markers'] and os.path.isfile(self._markers_filename)
+                self._journal['organs'] = previous['organs']
+            self.remove_partial_files()
+        self._write()
+
+    def _read(self):
+        try:
+            with open(self._filename) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write(self):
+        temporary_filename = self._filename + TEMPORARY_SUFFIX
+        with open(temporary_filename, 'w') as f:
+            json.dump(self._journal, f, indent=4)
+        os.replace(temporary_filename, self._filename)
+
+    def remove_partial_files(self, output_filenames=()):
+        """
+        Remove journal files, and output_filenames, left partly written under their temporary names by an
+        interrupted run. Other files in the output directory are left alone, as it may be shared.
+
+        :param output_filenames: Names of files the run writes.
+        """
+        for filename in (self._filename, self._markers_filename) + tuple(output_filenames):
+            temporary_filename = filename + TEMPORARY_SUFFIX
+            if os.path.isfile(temporary_filename):
+                os.remove(temporary_filename)
+
+    def organ_fingerprint(self, organ_file, organ_name, fit_settings, preview=False):
+        """
+        :return: Hex digest identifying the organ file content and everything else its output depends on,
+            including the whole-body scaffold.
+        """
+        return organ_fingerprint(organ_file, organ_name, fit_settings, preview, self._whole_body_fingerprint)
+
+    def has_marker_data(self):
+        return self._journal['markers']
+
+    def get_marker_data_filename(self):
+        """
+        :return: Name of the binary marker data file, as written by MarkerData.write_binary().
+        """
+        return self._markers_filename
+
+    def record_marker_data(self, marker_data):
+        """
+        Keep marker data extracted from the whole-body scaffold for resuming.
+        """
+        temporary_filename = self._markers_filename + TEMPORARY_SUFFIX
+        marker_data.write_binary(temporary_filename)
+        os.replace(temporary_filename, self._markers_filename)
+        self._journal['markers'] = True
+        self._write()
+
+    def get_completed_output(self, organ_file, fingerprint):
+        """
+        :return: Output file of organ_file if it was completed with the same fingerprint and the output is
+            unchanged since, otherwise None.
+        """
+        record = self._journal['organs'].get(organ_file)
+        if record and (record['fingerprint'] == fingerprint) and \
+                (file_stamp(record['output']) == record['output_stamp']):
+            return record['output']
+        return None
+
+    def record_organ(self, organ_file, fingerprint, stages, output_file):
+        """
+        Record that organ_file is complete, after its output is completely written.
+
+        :param stages: Names of the stages run for the organ.
+        """
+        self._journal['organs'][organ_file] = {
+            'fingerprint': fingerprint,
+            'stages': stages,
+            'output': output_file,
+            'output_stamp': file_stamp(output_file),
+        }
+        self._write()
@@ -1,95 +1,998 @@
 import csv
+import gc
 import json
+import multiprocessing
 import os
+import shutil
+import sys
+
+from array import array
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
 
 from cmlibs.utils.zinc.general import ChangeManager
+from cmlibs.utils.zinc.group import match_fitting_group_names
+from cmlibs.utils.zinc.region import copy_fitting_data
 from cmlibs.utils.zinc.field import findOrCreateFieldGroup, findOrCreateFieldCoordinates,\
-    findOrCreateFieldStoredString
+    findOrCreateFieldStoredString, create_field_finite_element_clone
 from cmlibs.zinc.context import Context
 from cmlibs.zinc.field import Field
-from cmlibs.zinc.node import Node
-from cmlibs.zinc.result import RESULT_OK
+from cmlibs.zinc.result import RESULT_OK, RESULT_WARNING_PART_DONE
 
 from scaffoldfitter.fitter import Fitter
 from scaffoldfitter.fitterstepalign import FitterStepAlign
 from scaffoldfitter.fitterstepfit import FitterStepFit
 
+from mapclientplugins.organinserterstep.organfitsettings import get_fit_settings
+from mapclientplugins.organinserterstep.organinputscan import estimate_fit_cost, scan_ex_file, \
+    scan_ex_group_definition, validate_organ, validate_whole_body
+from mapclientplugins.organinserterstep.organinserterjournal import OrganInserterJournal, TEMPORARY_SUFFIX, \
+    organ_fingerprint
+from mapclientplugins.organinserterstep.organinserterprofile import PROFILE_FILENAME, StageProfiler
+from mapclientplugins.organinserterstep.organregistry import get_organ_registry
+from mapclientplugins.organinserterstep.organtemplates import TEMPLATE_FIELD_NAME
+
 
 class OrganInserter(object):
-    def __init__(self, input_model_file, input_data_files, output_directory):
+    def __init__(self, input_model_file, input_data_files, output_directory, number_of_workers=1,
+                 write_marker_file=False, cache=None, progress_callback=None, cancel_event=None,
+                 profiler=None, write_profile=False, combined_output=False, reuse_outputs=None, fit_settings=None,
+                 organ_fit_settings=None, preview=False, low_memory=False, journal=False, resume=False,
+                 templates=None, organ_names=None):
+        """
+        Insert each organ in input_data_files into the whole-body scaffold.
+
+        :param input_model_file: Whole-body scaffold file with embedded markers.
+        :param input_data_files: List of organ scaffold files. Their headers are checked before any are read,
+            and organs are transformed in decreasing order of estimated fit cost. A file listed more than once
+            is inserted once. Files with the same content, organ name and fit settings as an earlier file are
+            fitted once and share its output, linked or copied to their own output name. Files whose output
+            name would overwrite the output of a different organ are recorded as errors.
+        :param output_directory: Directory to write transformed organ files to.
+        :param number_of_workers: Number of worker processes to transform organs in. With 1 (default) all
+            organs are transformed serially in this process.
+        :param write_marker_file: Set to True to also write the marker coordinates to an .exnode file in
+            output_directory. Organ fits always use the marker data in memory.
+        :param cache: Optional OrganResultCache to reuse transformed organs and whole-body marker data from.
+        :param progress_callback: Optional callable(input_data_file, finished_count, total_count) called
+            as each organ finishes, successfully or not.
+        :param cancel_event: Optional threading.Event; once set, organs not yet started are skipped.
+        :param profiler: Optional StageProfiler to record stage events with; a new one is made if not set.
+        :param write_profile: Set to True to write a summary of stage events to organinserter_profile.json
+            in output_directory.
+        :param combined_output: Set to True to also write the whole body and all transformed organs to one
+            file, with each organ in a child region. Organs are appended as they finish. The outputs of organs
+            which are not fitted are then links to their input with the organ group in a sidecar file, rather
+            than self-contained copies.
+        :param reuse_outputs: Optional dict input data file -> output file from a previous run to use instead
+            of transforming the organ again.
+        :param fit_settings: Optional dict of fit settings overriding DEFAULT_FIT_SETTINGS.
+        :param organ_fit_settings: Optional dict organ name -> dict of fit settings overriding fit_settings for
+            that organ.
+        :param preview: Set to True to only align organs to the markers, writing preview outputs and transform
+            records. Full fits can then be made on demand with get_fitted_output_file().
+        :param low_memory: Set to True to bound memory use: each organ is transformed in a new worker process
+            which exits when the organ's output is written, so its memory is returned to the system and peak
+            memory is reported per organ, and the marker data is released when finished. Adds the time to start
+            a process for each organ.
+        :param journal: Set to True to record marker data and completed organs in a journal in output_directory
+            as the run progresses.
+        :param resume: Set to True with journal to resume from the journal of an interrupted run, reusing its
+            marker data and the outputs of organs it completed with unchanged inputs and settings.
+        :param templates: Optional OrganTemplateLibrary to warm-start fits of organs with the warm_start fit
+            setting from, and to store their fitted shapes in for later subjects.
+        :param organ_names: Optional dict input data file -> organ name, giving the organ group name and whether
+            the organ is fitted. Organs of other files are named by get_organ_name().
+        """
         # Initializing with input parameters
+        input_data_files = list(dict.fromkeys(input_data_files))
+        self._input_model_file = input_model_file
         self._input_data_files = input_data_files
-        marker_coordinates = MarkerCoordinates(input_model_file, output_directory)
+        self._output_directory = output_directory
+        self._cache = cache
+        self._preview = preview
+        self._low_memory = low_memory
+        self._templates = templates
+        self._organ_names = dict(organ_names) if organ_names else {}
+        self._fitted_outputs = {}
+        self._progress_callback = progress_callback
+        self._cancel_event = cancel_event
+        self._finished_count = 0
+        self._profiler = profiler if profiler else StageProfiler()
+        self._fit_settings = fit_settings
+        self._organ_fit_settings = organ_fit_settings if organ_fit_settings else {}
+        reuse_outputs = dict(reuse_outputs) if reuse_outputs else {}
+        self._journal = None
+        self._fingerprints = {}
+        if journal:
+            with self._profiler.stage('read journal'):
+                self._journal = OrganInserterJournal(output_directory, input_model_file, resume=resume)
+                if resume:
+                    self._journal.remove_partial_files(self._get_output_filenames(combined_output))
+                for file in input_data_files:
+                    if (file not in reuse_outputs) and os.path.isfile(file):
+                        self._fingerprints[file] = self._journal.organ_fingerprint(
+                            file, self.get_input_organ_name(file), self._get_organ_fit_settings(file), preview)
+                        output_filename = self._journal.get_completed_output(file, self._fingerprints[file])
+                        if output_filename:
+                            reuse_outputs[file] = output_filename
+        if not combined_output:
+            # outputs with their organ group in a sidecar file were only written for a combined output
+            reuse_outputs = {file: output_filename for file, output_filename in reuse_outputs.items()
+                             if not os.path.exists(get_group_sidecar_filename(output_filename))}
+        self._reused_files = [file for file in input_data_files if file in reuse_outputs]
+        transform_files = [file for file in input_data_files if file not in reuse_outputs]
+        self._errors = {}
+        self._duplicates = {}
+        self._marker_data = None
+        if transform_files or write_marker_file:
+            transform_files = self._find_duplicates(self._check_inputs(transform_files))
+            self._marker_data = self._get_marker_data()
+            if write_marker_file:
+                with self._profiler.stage('write marker file'):
+                    MarkerCoordinates.write_marker_file(input_model_file, self._marker_data, output_directory)
 
         # Write annotations to a CSV file
         # self.write_annotations(output_directory)
 
-        # Transform and add organ groups
-        self._output_filenames = []
-        for file in input_data_files:
-            if 'colon' in file.lower():
-                self._output_filenames.append(file)
-                self.add_organ_group(file)
+        # Transform and add organ groups; failure of one organ does not stop the others.
+        # Output filenames are kept in the order of the input data files.
+        self._outputs = {}
+        self._combined_output = CombinedOutput(input_model_file, output_directory) if combined_output else None
+        for file in self._reused_files:
+            self._outputs[file] = reuse_outputs[file]
+            self._add_to_combined_output(file, reuse_outputs[file])
+            self._report_progress(file)
+        arguments = [(file, self._marker_data, output_directory, self._get_organ_fit_settings(file), cache, preview,
+                      templates, self.get_input_organ_name(file), combined_output) for file in transform_files]
+        try:
+            if ((number_of_workers > 1) and (len(transform_files) > 1)) or (low_memory and transform_files):
+                self._insert_organs_in_workers(arguments, min(number_of_workers, len(transform_files)), low_memory)
+            else:
+                for args in arguments:
+                    if self.is_cancelled():
+                        break
+                    try:
+                        events_count = len(self._profiler.get_events())
+                        output_filename = insert_organ(*args, profiler=self._profiler)
+                        self._add_output(args[0], output_filename, self._profiler.get_events()[events_count:])
+                    except Exception as e:
+                        self._record_error(args[0], e)
+                    self._report_progress(args[0])
+                    self._share_with_duplicates(args[0])
+        except BaseException:
+            if self._combined_output:
+                self._combined_output.discard()
+                self._combined_output = None
+            raise
+        self._output_filenames = [self._outputs[file] for file in input_data_files if file in self._outputs]
+        if self._combined_output:
+            if self.is_cancelled():
+                self._combined_output.discard()
+                self._combined_output = None
             else:
-                organ_transformer = OrganTransformer(file, marker_coordinates.output_filename(), output_directory)
-                self._output_filenames.append(organ_transformer.output_filename())
-                self.add_organ_group(organ_transformer.output_filename())
+                self._combined_output.close()
+        if cache:
+            cache.evict()
+        if templates:
+            templates.evict()
+        if low_memory:
+            self._marker_data = None
+        if write_profile:
+            self._profiler.write(os.path.join(output_directory, PROFILE_FILENAME))
+
+    def _insert_organs_in_workers(self, arguments, max_workers, low_memory):
+        """
+        Insert organs in spawned worker processes, so that each one creates its own zinc context from scratch.
+        In low memory mode each worker process only transforms one organ. Before Python 3.11 executors cannot
+        limit tasks per process, so a new single process executor is used for each organ.
+        If a worker process dies, the organs running in its executor are recorded as errors and the rest are
+        inserted by a new executor.
+
+        :param arguments: List of argument tuples for insert_organ(), in the order to start them.
+        :param max_workers: Maximum number of organs to insert at once.
+        """
+        context = multiprocessing.get_context('spawn')
+        organ_executors = low_memory and (sys.version_info < (3, 11))
+        executor_options = {'max_tasks_per_child': 1} if (low_memory and not organ_executors) else {}
+        executor = None
+        executor_used = False
+        queued = list(arguments)
+        futures = {}
+        pending = set()
+        try:
+            while queued or pending:
+                if self.is_cancelled():
+                    queued = []
+                    for future in pending:
+                        future.cancel()
+                # submit organs as workers become free
+                while queued and (len(pending) < max_workers):
+                    args = queued.pop(0)
+                    if organ_executors:
+                        organ_executor = ProcessPoolExecutor(max_workers=1, mp_context=context)
+                    else:
+                        if executor is None:
+                            executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=context,
+                                                           **executor_options)
+                            executor_used = False
+                        organ_executor = executor
+                    try:
+                        future = organ_executor.submit(_insert_organ_profiled, *args)
+                    except BrokenProcessPool as e:
+                        organ_executor.shutdown(wait=False)
+                        if (organ_executor is executor) and executor_used:
+                            # a worker died since the last wait; the organs it was running fail when waited
+                            # for, and this one is submitted to a new executor
+                            executor = None
+                            queued.insert(0, args)
+                        else:
+                            self._record_error(args[0], e)
+                            self._report_progress(args[0])
+                            self._share_with_duplicates(args[0])
+                        continue
+                    executor_used = True
+                    futures[future] = (args[0], organ_executor)
+                    pending.add(future)
+                if not pending:
+                    continue
+                done, pending = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+                for future in done:
+                    file, organ_executor = futures.pop(future)
+                    if organ_executor is not executor:
+                        organ_executor.shutdown()
+                    if future.cancelled():
+                        continue
+                    try:
+                        output_filename, events = future.result()
+                        for event in events:
+                            self._profiler.add_event(event)
+                        self._add_output(file, output_filename, events)
+                    except BrokenProcessPool as e:
+                        self._record_error(file, "Worker process stopped: {}".format(e))
+                        if organ_executor is executor:
+                            executor.shutdown(wait=False)
+                            executor = None
+                    except Exception as e:
+                        self._record_error(file, e)
+                    self._report_progress(file)
+                    self._share_with_duplicates(file)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    def _check_inputs(self, transform_files):
+        """
+        Check the whole-body and organ files from their headers before reading any into zinc.
+        Organ files with problems are recorded as errors and skipped.
+
+        :param transform_files: Organ files to transform.
+        :return: Organ files without problems, in decreasing order of estimated fit cost so the largest
+            start first.
+        """
+        registry = get_organ_registry()
+        with self._profiler.stage('check inputs'):
+            try:
+                problems = validate_whole_body(scan_ex_file(self._input_model_file))
+            except OSError as e:
+                problems = [str(e)]
+            if problems:
+                raise ValueError("Invalid whole-body scaffold {}: {}".format(self._input_model_file,
+                                                                             '; '.join(problems)))
+            costs = {}
+            for file in transform_files:
+                fit = registry.is_fitted(self.get_input_organ_name(file))
+                try:
+                    summary = scan_ex_file(file)
+                    problems = validate_organ(summary, fit)
+                except OSError as e:
+                    problems = [str(e)]
+                if problems:
+                    self._record_error(file, "Invalid organ scaffold: " + '; '.join(problems))
+                    self._report_progress(file)
+                else:
+                    costs[file] = estimate_fit_cost(summary) if fit else 0
+        return sorted(costs, key=costs.get, reverse=True)
+
+    def _find_duplicates(self, transform_files):
+        """
+        Find organ files with the same content, organ name and fit settings as an earlier file, to insert
+        once and share the output of, and files whose output name is the same as that of a different organ,
+        which are recorded as errors and skipped.
+
+        :param transform_files: Organ files to transform. Earlier files in input_data_files are kept.
+        :return: Organ files to transform, without duplicates and collisions, in the same order.
+        """
+        primary_files = {}
+        output_fingerprints = {}
+        unique_files = set()
+        with self._profiler.stage('find duplicates'):
+            for file in self._input_data_files:
+                if file not in transform_files:
+                    continue
+                fingerprint = self._fingerprints.get(file) or organ_fingerprint(
+                    file, self.get_input_organ_name(file), self._get_organ_fit_settings(file), self._preview)
+                output_filename = get_organ_output_filename(file, self._output_directory, self._preview,
+                                                            self.get_input_organ_name(file))
+                if output_fingerprints.setdefault(output_filename, fingerprint) != fingerprint:
+                    self._record_error(file, "Output file {} is also the output of a different organ".format(
+                        output_filename))
+                    self._report_progress(file)
+                    continue
+                primary_file = primary_files.setdefault(fingerprint, file)
+                if primary_file != file:
+                    self._duplicates[file] = primary_file
+                    print("Organ file {} is identical to {}; inserting once".format(file, primary_file))
+                    continue
+                unique_files.add(file)
+        return [file for file in transform_files if file in unique_files]
+
+    def _share_with_duplicates(self, input_data_file):
+        """
+        Give the duplicates of input_data_file its output, or an error if it failed.
+        """
+        for file, primary_file in self._duplicates.items():
+            if primary_file != input_data_file:
+                continue
+            try:
+                if input_data_file not in self._outputs:
+                    raise ValueError("Identical organ file {} failed: {}".format(
+                        input_data_file, self._errors.get(input_data_file)))
+                events_count = len(self._profiler.get_events())
+                output_filename = self._share_output(file, self._outputs[input_data_file], self._preview)
+                self._add_output(file, output_filename, self._profiler.get_events()[events_count:])
+            except Exception as e:
+                self._record_error(file, e)
+            self._report_progress(file)
+
+    def _share_output(self, input_data_file, output_filename, preview):
+        """
+        Hard link output_filename and any group sidecar to the output name of input_data_file, or copy them if
+        links are not supported. Outputs are always replaced rather than rewritten, so linked outputs never change
+        together.
+
+        :return: Name of the output file for input_data_file.
+        """
+        organ_name = self.get_input_organ_name(input_data_file)
+        shared_filename = get_organ_output_filename(input_data_file, self._output_directory, preview, organ_name)
+        if shared_filename != output_filename:
+            with self._profiler.stage('share duplicate', organ_name, input_data_file,
+                                      shared_filename):
+                for filename, shared in (
+                        (get_group_sidecar_filename(output_filename), get_group_sidecar_filename(shared_filename)),
+                        (output_filename, shared_filename)):
+                    temporary_filename = shared + TEMPORARY_SUFFIX
+                    if os.path.exists(temporary_filename):
+                        os.remove(temporary_filename)
+                    if os.path.exists(filename):
+                        link_file(filename, temporary_filename)
+                        os.replace(temporary_filename, shared)
+                    elif os.path.exists(shared):
+                        os.remove(shared)
+        return shared_filename
+
+    def _get_marker_data(self):
+        """
+        :return: MarkerData for the whole-body scaffold, from the journal being resumed or the cache if
+            available, otherwise evaluated and then stored in the cache. Recorded in the journal if kept.
+        """
+        if self._journal and self._journal.has_marker_data():
+            with self._profiler.stage('read journal markers'):
+                return MarkerData.read_binary(self._journal.get_marker_data_filename())
+        key = None
+        marker_data = None
+        if self._cache:
+            with self._profiler.stage('fetch cached markers', input_file=self._input_model_file):
+                key = self._cache.marker_data_key(self._input_model_file)
+                marker_data = self._cache.fetch_marker_data(key)
+        if marker_data is None:
+            marker_coordinates = MarkerCoordinates(self._input_model_file, profiler=self._profiler)
+            marker_data = marker_coordinates.marker_data()
+            marker_coordinates.release()
+            if self._low_memory:
+                del marker_coordinates
+                gc.collect()
+            if self._cache:
+                with self._profiler.stage('store cached markers'):
+                    self._cache.store_marker_data(key, marker_data)
+        if self._journal:
+            with self._profiler.stage('write journal markers'):
+                self._journal.record_marker_data(marker_data)
+        return marker_data
+
+    def _add_output(self, input_data_file, output_filename, events):
+        """
+        Add the output of a completed organ, recording it in the journal and the combined output.
+
+        :param events: Stage events for the organ.
+        """
+        self._outputs[input_data_file] = output_filename
+        self._record_organ(input_data_file, output_filename, events)
+        self._add_to_combined_output(input_data_file, output_filename)
+
+    def _record_organ(self, input_data_file, output_filename, events):
+        """
+        Record a completed organ in the journal, if kept.
+
+        :param events: Stage events for the organ.
+        """
+        if self._journal and (input_data_file in self._fingerprints):
+            self._journal.record_organ(input_data_file, self._fingerprints[input_data_file],
+                                       [event['stage'] for event in events], output_filename)
+
+    def _get_output_filenames(self, combined_output):
+        """
+        :return: Names of all files which may be written for the input files, in either preview mode.
+        """
+        output_filenames = [CombinedOutput.get_output_filename(self._input_model_file, self._output_directory)] \
+            if combined_output else []
+        for file in self._input_data_files:
+            organ_name = self.get_input_organ_name(file)
+            for preview in (False, True):
+                output_filename = get_organ_output_filename(file, self._output_directory, preview, organ_name)
+                output_filenames += [output_filename, get_group_sidecar_filename(output_filename)]
+                if preview:
+                    output_filenames.append(os.path.splitext(output_filename)[0] + '.json')
+        return output_filenames
+
+    def _get_organ_fit_settings(self, input_data_file):
+        return get_fit_settings(self._fit_settings,
+                                self._organ_fit_settings.get(self.get_input_organ_name(input_data_file)))
+
+    def get_fitted_output_file(self, input_data_file):
+        """
+        Get the fully fitted output for an organ. After a preview, the organ is fitted the first time
+        this is called for it, reusing the cache if set.
+
+        :return: Name of the fitted output file.
+        """
+        if not self._preview:
+            return self._outputs[input_data_file]
+        if input_data_file in self._duplicates:
+            if input_data_file not in self._fitted_outputs:
+                self._fitted_outputs[input_data_file] = self._share_output(
+                    input_data_file, self.get_fitted_output_file(self._duplicates[input_data_file]), False)
+        elif input_data_file not in self._fitted_outputs:
+            if self._marker_data is None:
+                self._marker_data = self._get_marker_data()
+            self._fitted_outputs[input_data_file] = insert_organ(
+                input_data_file, self._marker_data, self._output_directory,
+                self._get_organ_fit_settings(input_data_file), self._cache, templates=self._templates,
+                organ_name=self.get_input_organ_name(input_data_file), profiler=self._profiler)
+        return self._fitted_outputs[input_data_file]
+
+    def _add_to_combined_output(self, input_data_file, output_filename):
+        if self._combined_output:
+            organ_name = self.get_input_organ_name(input_data_file)
+            with self._profiler.stage('add to combined output', organ_name, output_filename):
+                self._combined_output.add_organ(output_filename, organ_name)
+
+    def _record_error(self, filename, error):
+        self._errors[filename] = str(error)
+        print("Failed to insert organ ({}): {}".format(filename, error))
+
+    def _report_progress(self, filename):
+        self._finished_count += 1
+        if self._progress_callback:
+            self._progress_callback(filename, self._finished_count, len(self._input_data_files))
+
+    def is_cancelled(self):
+        return (self._cancel_event is not None) and self._cancel_event.is_set()
 
     def get_output_file_name(self):
         return self._output_filenames
 
+    def get_combined_output_file_name(self):
+        """
+        :return: Name of the combined output file, or None if not written.
+        """
+        return self._combined_output.output_filename() if self._combined_output else None
+
+    def get_output_file_for(self, input_data_file):
+        """
+        :return: Name of the output file for input_data_file, or None if it was not inserted.
+        """
+        return self._outputs.get(input_data_file)
+
+    def get_reused_files(self):
+        """
+        :return: List of input data files whose output from a previous run was reused.
+        """
+        return self._reused_files
+
+    def get_profiler(self):
+        return self._profiler
+
+    def get_duplicates(self):
+        """
+        :return: dict input data file -> earlier input data file with the same content, organ name and fit
+            settings, whose output it shares.
+        """
+        return self._duplicates
+
+    def get_errors(self):
+        """
+        :return: dict input data file name -> error message for organs which failed to insert.
+        """
+        return self._errors
+
     # Method to extract organ name from file name
-    def get_organ_name(self, filename):
-        organsList = ['lung', 'heart', 'brainstem', 'stomach', 'bladder']
-        filename_base = os.path.basename(filename).split('.')[0]
-        for organ_name in organsList:
-            if organ_name in filename_base.lower():
-                return organ_name
-        else:
-            return filename_base
+    @staticmethod
+    def get_organ_name(filename):
+        return get_organ_registry().get_organ_name(filename)
+
+    def get_input_organ_name(self, input_data_file):
+        """
+        :return: Organ name given for input_data_file, otherwise the name from its file name.
+        """
+        return self._organ_names.get(input_data_file) or self.get_organ_name(input_data_file)
 
     # Method to write annotations to a CSV file
     def write_annotations(self, output_directory):
-        DOI = ["https://doi.org/10.26275/yibc-wyu2", "https://doi.org/10.26275/dqpf-gqdt",
-               "https://doi.org/10.26275/rets-qdch", "https://doi.org/10.26275/dqpf-gqdt",
-               "https://doi.org/10.26275/yum2-z4uf", "https://doi.org/10.26275/xq3h-ba2b", "colon"]
-        organ_names = ['whole-body']
-        for filename in self._input_data_files:
-            organ_names.append(self.get_organ_name(filename))
+        registry = get_organ_registry()
+        whole_body_name = registry.get_whole_body_name()
 
         # Writing annotations to CSV
         annotation_file = os.path.join(output_directory, 'organinserter_annotations.csv')
         with open(annotation_file, 'w', newline='') as fout:
             writer = csv.writer(fout)
             writer.writerow(['Organ name', 'Source', 'File name', 'Transformed file name'])
-            writer.writerow([organ_names[0], DOI[0], 'whole_body.exf', 'whole_body.exf'])
-            for c, filename in enumerate(self._input_data_files):
+            writer.writerow([whole_body_name, registry.get_source(whole_body_name), 'whole_body.exf', 'whole_body.exf'])
+            for filename in self._input_data_files:
+                organ_name = self.get_input_organ_name(filename)
                 filenamebase = os.path.basename(filename)
-                writer.writerow([organ_names[c + 1], DOI[c + 1], filenamebase,
-                                 filenamebase.split('.')[0] + '_transfromed_fit1.exf'])
+                writer.writerow([organ_name, registry.get_source(organ_name), filenamebase,
+                                 os.path.basename(self._outputs.get(filename, filenamebase))])
 
     # Method to add organ group
-    def add_organ_group(self, filename):
-        # Creating context and region
-        context = Context('organGroup')
-        region = context.createRegion()
-        region.readFile(filename)
+    @staticmethod
+    def add_organ_group(filename, output_filename, organ_name=None, group_sidecar=False):
+        """
+        Write filename with its organ group added to output_filename, leaving filename unchanged.
+        If filename already has the organ group it is hard linked. Otherwise the group definition is made by
+        scanning filename, and with group_sidecar filename is hard linked and the group definition is written to
+        the sidecar file named by get_group_sidecar_filename(), so neither is read into zinc or copied. Without
+        group_sidecar a self-contained output is written by appending the group definition to a clone or copy
+        of filename.
+
+        :param organ_name: Name of the organ group. Defaults to the name from the file name.
+        :param group_sidecar: Set to True if the output is only read with its sidecar, as by CombinedOutput.
+        """
+        if not organ_name:
+            organ_name = OrganInserter.get_organ_name(filename)
+        group_definition = None
+        if organ_name not in scan_ex_file(filename)['groups']:
+            group_definition = scan_ex_group_definition(filename, organ_name)
+            if group_definition is None:
+                # older formats and files with several regions are not scanned
+                group_definition = get_organ_group_definition(filename, organ_name)
+        temporary_filename = output_filename + TEMPORARY_SUFFIX
+        if os.path.exists(temporary_filename):
+            os.remove(temporary_filename)
+        sidecar_filename = get_group_sidecar_filename(output_filename)
+        if group_definition and not group_sidecar:
+            clone_file(filename, temporary_filename)
+            with open(temporary_filename, 'rb+') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    f.write(b'\n')
+                f.write(group_definition)
+        else:
+            link_file(filename, temporary_filename)
+        if group_definition and group_sidecar:
+            with open(sidecar_filename + TEMPORARY_SUFFIX, 'wb') as f:
+                f.write(GROUP_SIDECAR_HEADER)
+                f.write(group_definition)
+            os.replace(sidecar_filename + TEMPORARY_SUFFIX, sidecar_filename)
+        elif os.path.exists(sidecar_filename):
+            os.remove(sidecar_filename)
+        os.replace(temporary_filename, output_filename)
+
+
+# Sidecar files hold only the organ group of an output, which continues the region of the output
+GROUP_SIDECAR_SUFFIX = '.group'
+GROUP_SIDECAR_HEADER = b'EX Version: 3\nRegion: /\n'
+
+
+def get_group_sidecar_filename(output_filename):
+    """
+    :return: Name of the file holding the organ group of output_filename, if written separately.
+    """
+    return output_filename + GROUP_SIDECAR_SUFFIX
+
+
+def get_organ_group_definition(filename, organ_name):
+    """
+    Read filename into zinc and make its organ group, for files scan_ex_group_definition() cannot scan.
+
+    :return: Group definition as bytes, to append to filename.
+    """
+    context = Context('organGroup')
+    region = context.createRegion()
+    region.readFile(filename)
+    field_module = region.getFieldmodule()
+    create_organ_group(field_module, organ_name)
+    stream_information = region.createStreaminformationRegion()
+    memory_resource = stream_information.createStreamresourceMemory()
+    stream_information.setResourceFieldNames(memory_resource, [organ_name])
+    stream_information.setResourceGroupName(memory_resource, organ_name)
+    region.write(stream_information)
+    buffer = memory_resource.getBuffer()[1]
+    # zinc lists the group's nodes and elements before the group definition; they are already in filename
+    return buffer[buffer.index('Group name: {}\n'.format(organ_name).encode()):]
+
+
+def link_file(filename, output_filename):
+    """
+    Hard link filename to output_filename, or clone or copy it if links are not supported.
+    """
+    try:
+        os.link(filename, output_filename)
+    except OSError:
+        clone_file(filename, output_filename)
+
+
+# Linux ioctl request to clone a file on file systems with copy-on-write support
+FICLONE = 0x40049409
+
+
+def clone_file(filename, output_filename):
+    """
+    Copy filename to output_filename, as a copy-on-write clone sharing storage with filename where the file system
+    supports it.
+    """
+    if fcntl is not None:
+        with open(filename, 'rb') as source, open(output_filename, 'wb') as target:
+            try:
+                fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+                return
+            except OSError:
+                pass
+    shutil.copyfile(filename, output_filename)
+
+
+def create_affine_transform_field(coordinates, matrix):
+    """
+    :param coordinates: Field with 3 components.
+    :param matrix: 4x4 row-major affine transformation matrix M, transforming p = [x, y, z, 1] to p' = Mp.
+    :return: Zinc field giving coordinates transformed by matrix.
+    """
+    field_module = coordinates.getFieldmodule()
+    with ChangeManager(field_module):
+        linear = field_module.createFieldConstant([matrix[i][j] for i in range(3) for j in range(3)])
+        translation = field_module.createFieldConstant([matrix[i][3] for i in range(3)])
+        return field_module.createFieldMatrixMultiply(3, linear, coordinates) + translation
+
+
+def invert_similarity_transform(matrix):
+    """
+    :param matrix: 4x4 row-major matrix for scaling by s, rotating by R then translating by t, as returned by
+        FitterStepAlign.getTransformationMatrix().
+    :return: 4x4 row-major inverse matrix, with linear part (sR)^-1 = (sR)^T / s^2.
+    """
+    scale_squared = sum(matrix[i][0] ** 2 for i in range(3))
+    linear = [[matrix[j][i] / scale_squared for j in range(3)] for i in range(3)]
+    translation = [-sum(linear[i][j] * matrix[j][3] for j in range(3)) for i in range(3)]
+    return [linear[i] + [translation[i]] for i in range(3)] + [[0.0, 0.0, 0.0, 1.0]]
+
+
+def get_organ_output_filename(input_data_file, output_directory, preview=False, organ_name=None):
+    """
+    :param organ_name: Name of the organ. Defaults to the name from the file name.
+    :return: Name of the output file insert_organ() writes for input_data_file.
+    """
+    if not organ_name:
+        organ_name = OrganInserter.get_organ_name(input_data_file)
+    if not get_organ_registry().is_fitted(organ_name):
+        file_basename = os.path.basename(input_data_file).split('.')[0]
+        return os.path.join(output_directory, file_basename + '_grouped.exf')
+    return OrganTransformer.get_output_filename(input_data_file, output_directory, preview)
+
+
+def create_organ_group(field_module, organ_name, conditional_field=None):
+    """
+    Add all 3D elements and their faces and nodes to group organ_name, which is created if the organ scaffold
+    does not already have it, as annotated scaffolds usually do.
+
+    :param conditional_field: Optional field limiting the 3D elements to those where it is true.
+    :return: Zinc FieldGroup.
+    """
+    mesh = field_module.findMeshByDimension(3)
+    with ChangeManager(field_module):
+        field_group = findOrCreateFieldGroup(field_module, organ_name)
+        field_group.setSubelementHandlingMode(field_group.SUBELEMENT_HANDLING_MODE_FULL)
+        mesh_group = field_group.getOrCreateMeshGroup(mesh)
+        is_organ = conditional_field if conditional_field else field_module.createFieldConstant(1)
+        mesh_group.addElementsConditional(is_organ)
+    assert field_group.getName() == organ_name, \
+        "Failed to make organ group {}; the name is used by another field".format(organ_name)
+    return field_group
+
+
+def insert_organ(input_data_file, marker_data, output_directory, fit_settings=None, cache=None, preview=False,
+                 templates=None, organ_name=None, group_sidecar=False, profiler=None):
+    """
+    Transform a single organ to the marker data and add its organ group. Organs which are not fitted are
+    passed through, with their organ group added to a copy in output_directory.
+    Module level so it can be run in a worker process.
+
+    :param marker_data: MarkerData or name of zinc file with marker data.
+    :param fit_settings: Optional dict of fit settings overriding DEFAULT_FIT_SETTINGS.
+    :param cache: Optional OrganResultCache to fetch the output from and store it in. Requires MarkerData.
+        Not used for previews or fits warm-started from a template.
+    :param preview: Set to True to only align the organ, writing a preview output and transform record.
+    :param templates: Optional OrganTemplateLibrary to warm-start the fit from and store the fitted organ in, if
+        the warm_start fit setting is on.
+    :param organ_name: Name of the organ. Defaults to the name from the file name.
+    :param group_sidecar: Set to True to write the organ group of organs which are not fitted to a sidecar file,
+        if the output is only added to a CombinedOutput.
+    :param profiler: Optional StageProfiler to record stage events with.
+    :return: Name of the output file for the organ.
+    """
+    if profiler is None:
+        profiler = StageProfiler()
+    organ = os.path.basename(input_data_file).split('.')[0]
+    if not get_organ_registry().is_fitted(organ_name or OrganInserter.get_organ_name(input_data_file)):
+        output_filename = get_organ_output_filename(input_data_file, output_directory, organ_name=organ_name)
+        with profiler.stage('add organ group', organ, input_data_file, output_filename):
+            OrganInserter.add_organ_group(input_data_file, output_filename, organ_name, group_sidecar)
+        return output_filename
+
+    fit_settings = get_fit_settings(fit_settings)
+    output_filename = OrganTransformer.get_output_filename(input_data_file, output_directory)
+    if not organ_name:
+        organ_name = OrganInserter.get_organ_name(output_filename)
+    if preview:
+        cache = None
+        output_filename = OrganTransformer.get_output_filename(input_data_file, output_directory, preview=True)
+    template_key = None
+    template_filename = None
+    store_template_filename = None
+    if templates and fit_settings['fit'] and fit_settings['warm_start'] and not preview:
+        with profiler.stage('fetch template', organ, input_data_file):
+            template_key = templates.key(input_data_file, organ_name)
+            template_filename = templates.fetch(template_key)
+            store_template_filename = templates.get_store_filename(template_key)
+    if template_filename:
+        # the output depends on the template, which changes with every fit
+        cache = None
+    key = None
+    if cache:
+        with profiler.stage('fetch cached', organ, input_data_file, output_filename):
+            key = cache.key(input_data_file, organ_name, marker_data, fit_settings)
+            found = cache.fetch(key, output_filename)
+        if found:
+            print("Reusing transformed organ ({}) from cache".format(os.path.basename(input_data_file)))
+            return output_filename
+    organ_transformer = OrganTransformer(input_data_file, marker_data, output_directory, fit_settings,
+                                         organ_name=organ_name, profiler=profiler, preview=preview,
+                                         template_filename=template_filename,
+                                         store_template_filename=store_template_filename)
+    output_filename = organ_transformer.output_filename()
+    if template_key:
+        templates.store(template_key, store_template_filename)
+    if cache:
+        with profiler.stage('store cached', organ, output_filename):
+            cache.store(key, output_filename)
+    return output_filename
+
+
+def _insert_organ_profiled(*args):
+    """
+    Call insert_organ with a new StageProfiler, for worker processes.
+
+    :return: Name of the output file for the organ, list of stage events.
+    """
+    profiler = StageProfiler()
+    output_filename = insert_organ(*args, profiler=profiler)
+    return output_filename, profiler.get_events()
+
+
+MARKER_DATA_BINARY_MAGIC = b'organinserter marker data 1\n'
+
+
+def normalize_marker_name(name):
+    """
+    :return: Marker name as compared by the fitter, ignoring case and leading and trailing whitespace.
+    """
+    return name.strip().casefold()
+
+
+# Marker coordinates held in memory
+class MarkerData(object):
+    """
+    Marker names and coordinates evaluated from a scaffold, stored as flat arrays.
+    Picklable, so can be passed to worker processes, and loaded into a fitter without writing a file.
+    """
+
+    def __init__(self, identifiers=None, coordinates=None, names=None, source_filename=None):
+        """
+        :param identifiers: Marker node identifiers.
+        :param coordinates: Flat x, y, z coordinates of markers in identifiers order.
+        :param names: Marker names in identifiers order.
+        :param source_filename: Name of the file the markers were evaluated from.
+        """
+        self._identifiers = array('l', identifiers if identifiers else [])
+        self._coordinates = array('d', coordinates if coordinates else [])
+        self._names = list(names) if names else []
+        self._source_filename = source_filename
+        self._name_index = None
+        assert len(self._coordinates) == 3 * len(self._identifiers) and len(self._names) == len(self._identifiers)
+
+    def __len__(self):
+        return len(self._identifiers)
+
+    def add(self, identifier, x, name):
+        self._identifiers.append(identifier)
+        self._coordinates.extend(x)
+        self._names.append(name)
+        self._name_index = None
+
+    def get_identifiers(self):
+        return self._identifiers
+
+    def get_coordinates(self):
+        """
+        :return: Flat array of x, y, z coordinates for all markers.
+        """
+        return self._coordinates
+
+    def get_names(self):
+        return self._names
+
+    def get_source_filename(self):
+        return self._source_filename
+
+    def get_name_index(self):
+        """
+        :return: dict normalized marker name -> list of marker indexes with that name. Built on first use.
+        """
+        if self._name_index is None:
+            self._name_index = {}
+            for i, name in enumerate(self._names):
+                self._name_index.setdefault(normalize_marker_name(name), []).append(i)
+        return self._name_index
+
+    def subset(self, names):
+        """
+        Get the markers matching any of names, as the fitter matches marker names. Markers with the same name
+        are all kept, so the fitter still ignores names which are not unique.
+
+        :param names: Iterable of marker names.
+        :return: MarkerData with the matching markers, in their original order.
+        """
+        name_index = self.get_name_index()
+        indexes = sorted(i for name in set(normalize_marker_name(name) for name in names)
+                         for i in name_index.get(name, ()))
+        coordinates = array('d')
+        for i in indexes:
+            coordinates.extend(self._coordinates[3 * i:3 * i + 3])
+        return MarkerData([self._identifiers[i] for i in indexes], coordinates, [self._names[i] for i in indexes],
+                          source_filename=self._source_filename)
+
+    def write_region(self, region):
+        """
+        Create marker nodes with fields marker_data_coordinates, marker_data_name in group 'marker'
+        in region, in the form read from a marker .exnode file.
+        """
         field_module = region.getFieldmodule()
-        mesh = field_module.findMeshByDimension(3)
         with ChangeManager(field_module):
-            # Creating field group for the organ
-            field_group = field_module.createFieldGroup()
-            organ_name = self.get_organ_name(filename)
-            field_group.setName(organ_name)
-            field_group.setSubelementHandlingMode(field_group.SUBELEMENT_HANDLING_MODE_FULL)
-            mesh_group = field_group.createMeshGroup(mesh)
-            is_organ = field_module.createFieldConstant(1)
-            mesh_group.addElementsConditional(is_organ)
-            sir = region.createStreaminformationRegion()
-            srm = sir.createStreamresourceMemory()
-            sir.setResourceGroupName(srm, organ_name)
-            region.write(sir)
-            region.writeFile(filename)
+            nodes = field_module.findNodesetByFieldDomainType(Field.DOMAIN_TYPE_NODES)
+            marker_data_coordinates = findOrCreateFieldCoordinates(field_module, name="marker_data_coordinates",
+                                                                   components_count=3)
+            marker_data_name = findOrCreateFieldStoredString(field_module, name="marker_data_name")
+            marker_data_group = findOrCreateFieldGroup(field_module, name="marker")
+            marker_data_nodes_group = marker_data_group.getOrCreateNodesetGroup(nodes)
+            node_template = nodes.createNodetemplate()
+            node_template.defineField(marker_data_name)
+            node_template.defineField(marker_data_coordinates)
+            field_cache = field_module.createFieldcache()
+            for i, identifier in enumerate(self._identifiers):
+                node = nodes.createNode(identifier, node_template)
+                marker_data_nodes_group.addNode(node)
+                field_cache.setNode(node)
+                marker_data_coordinates.assignReal(field_cache, list(self._coordinates[3 * i:3 * i + 3]))
+                if self._names[i]:
+                    marker_data_name.assignString(field_cache, self._names[i])
+
+    def write_binary(self, filename):
+        """
+        Write marker data to a compact binary file, restored exactly by read_binary(). Much faster to read than
+        evaluating markers from the scaffold or reading an .exnode file, so used to keep marker data between runs.
+        Format: magic line, JSON header line, identifiers as int64, coordinates as float64, then
+        NUL-separated UTF-8 names.
+        """
+        header = {
+            'count': len(self),
+            'byteorder': sys.byteorder,
+            'source_filename': self._source_filename,
+        }
+        with open(filename, 'wb') as f:
+            f.write(MARKER_DATA_BINARY_MAGIC)
+            f.write((json.dumps(header) + '\n').encode())
+            array('q', self._identifiers).tofile(f)
+            self._coordinates.tofile(f)
+            f.write('\0'.join(self._names).encode())
+
+    @classmethod
+    def read_binary(cls, filename):
+        """
+        :return: MarkerData read from a file written by write_binary().
+        """
+        with open(filename, 'rb') as f:
+            assert f.readline() == MARKER_DATA_BINARY_MAGIC, "Not a marker data binary file " + str(filename)
+            header = json.loads(f.readline().decode())
+            count = header['count']
+            identifiers = array('q')
+            identifiers.fromfile(f, count)
+            coordinates = array('d')
+            coordinates.fromfile(f, 3 * count)
+            names = f.read().decode().split('\0') if count else []
+        if header['byteorder'] != sys.byteorder:
+            identifiers.byteswap()
+            coordinates.byteswap()
+        marker_data = cls(source_filename=header['source_filename'])
+        marker_data._identifiers = array('l', identifiers)
+        marker_data._coordinates = coordinates
+        marker_data._names = names
+        assert len(names) == count, "Invalid marker names in marker data binary file " + str(filename)
+        return marker_data
+
+    def write_file(self, filename):
+        context = Context('markerData')
+        region = context.createRegion()
+        self.write_region(region)
+        result = region.writeFile(filename)
+        assert result == RESULT_OK, "Failed to write marker data file " + str(filename)
+
+
+# Fitter loading its data from MarkerData in memory instead of a zinc data file
+class MarkerDataFitter(Fitter):
+
+    def __init__(self, zinc_model_file, marker_data):
+        # the data file name is only used for messages
+        super().__init__(zinc_model_file, marker_data.get_source_filename() or 'marker data')
+        self._marker_data = marker_data
+
+    def _get_model_marker_names(self):
+        """
+        Call after the model is loaded.
+
+        :return: Names of markers in the model, or None if it has no marker group.
+        """
+        self._discoverMarkerGroup()
+        marker_nodes, _, _, marker_name = self.getMarkerModelFields()
+        if not (marker_nodes and marker_name):
+            return None
+        names = []
+        field_cache = self._fieldmodule.createFieldcache()
+        node_iter = marker_nodes.createNodeiterator()
+        node = node_iter.next()
+        while node.isValid():
+            field_cache.setNode(node)
+            names.append(marker_name.evaluateString(field_cache))
+            node = node_iter.next()
+        return names
+
+    def _loadData(self):
+        # Only markers with names in the model can be fitted to, and matching each data marker to the model
+        # is linear in the number of model markers, so load only those.
+        model_marker_names = self._get_model_marker_names()
+        marker_data = self._marker_data if model_marker_names is None else \
+            self._marker_data.subset(model_marker_names)
+        marker_data.write_region(self._rawDataRegion)
+        data_fieldmodule = self._rawDataRegion.getFieldmodule()
+        with ChangeManager(data_fieldmodule):
+            match_fitting_group_names(data_fieldmodule, self._fieldmodule,
+                                      log_diagnostics=self.getDiagnosticLevel() > 0)
+            copy_fitting_data(self._region, self._rawDataRegion)
+        self._discoverDataCoordinatesField()
+        self._discoverMarkerGroup()
 
 
 # Base class for output files
@@ -102,39 +1005,318 @@ class BaseOutputFile(object):
         return self._output_filename
 
 
+# Class for streaming the whole body and transformed organs into one file
+class CombinedOutput(BaseOutputFile):
+    """
+    Writes the whole-body scaffold followed by each organ file in a child region named for the organ.
+    Organ files are appended as text as they are added, so they are not read into zinc again, and as each organ
+    is in its own region their node and element identifiers do not clash with the whole body or other organs.
+    The file is written under a temporary name until closed.
+    """
+
+    def __init__(self, whole_body_file, output_directory):
+        super().__init__()
+        self._output_filename = self.get_output_filename(whole_body_file, output_directory)
+        self._temporary_filename = self._output_filename + TEMPORARY_SUFFIX
+        self._region_names = set()
+        self._file = open(self._temporary_filename, 'w')
+        self._append(whole_body_file)
+
+    @staticmethod
+    def get_output_filename(whole_body_file, output_directory):
+        file_basename = os.path.basename(whole_body_file).split('.')[0]
+        return os.path.join(output_directory, file_basename + '_combined.exf')
+
+    def _append(self, filename, region_name=None, continue_region=False):
+        """
+        Append EX file content, replacing its header with a child region header if region_name is set.
+
+        :param continue_region: Set to True to omit the header, continuing the region appended last.
+        """
+        with open(filename, 'r') as f:
+            if region_name or continue_region:
+                line = f.readline()
+                if line.startswith('EX Version'):
+                    line = f.readline()
+                if not continue_region:
+                    self._file.write('Region: /{}\n'.format(region_name))
+                if not line.startswith('Region:'):
+                    self._file.write(line)
+            block = ''
+            for block in iter(lambda: f.read(1 << 20), ''):
+                self._file.write(block)
+            if block and not block.endswith('\n'):
+                self._file.write('\n')
+
+    def add_organ(self, organ_file, organ_name):
+        """
+        Append organ_file in a child region named organ_name, or organ_name_2, etc. if already used, followed by
+        its group sidecar file if it has one.
+
+        :return: Name of the child region.
+        """
+        base_region_name = organ_name.replace('/', '_')
+        region_name = base_region_name
+        count = 1
+        while region_name in self._region_names:
+            count += 1
+            region_name = '{}_{}'.format(base_region_name, count)
+        self._region_names.add(region_name)
+        self._append(organ_file, region_name)
+        sidecar_filename = get_group_sidecar_filename(organ_file)
+        if os.path.exists(sidecar_filename):
+            self._append(sidecar_filename, continue_region=True)
+        return region_name
+
+    def close(self):
+        self._file.close()
+        os.replace(self._temporary_filename, self._output_filename)
+
+    def discard(self):
+        self._file.close()
+        os.remove(self._temporary_filename)
+
+
 # Class for transforming organ models
 class OrganTransformer(BaseOutputFile):
 
-    def __init__(self, input_zinc_model_file, input_zinc_data_file, output_directory):
+    def __init__(self, input_zinc_model_file, input_zinc_data, output_directory, fit_settings=None,
+                 organ_name=None, profiler=None, preview=False, template_filename=None, store_template_filename=None):
+        """
+        :param input_zinc_model_file: Organ scaffold file to transform.
+        :param input_zinc_data: MarkerData to fit to, or name of zinc file with marker data.
+        :param output_directory: Directory to write transformed organ file to.
+        :param fit_settings: Optional dict of fit settings overriding DEFAULT_FIT_SETTINGS.
+        :param organ_name: Optional name of group containing the whole organ to add to the output.
+        :param profiler: Optional StageProfiler to record stage events with.
+        :param preview: Set to True to only align the organ to the markers, without writing intermediate files.
+            The aligned organ is written to <organ>_transformed_preview.exf with its transformation in
+            <organ>_transformed_preview.json.
+        :param template_filename: Optional template file, as written with store_template_filename, of the same
+            organ scaffold fitted for another subject, to start the fit from after aligning.
+        :param store_template_filename: Optional name of file to write the fitted organ to as a template for
+            warm-starting fits of the same organ scaffold.
+        """
         super().__init__()
-        # Initializing Fitter with input files
-        self._fitter = Fitter(input_zinc_model_file, input_zinc_data_file)
-        self._fitter.load()
-        self.set_model_coordinates_field()
-
+        profiler = profiler if profiler else StageProfiler()
+        self._preview = preview
+        fit_settings = get_fit_settings(fit_settings)
         # Generating output filename
         file_basename = os.path.basename(input_zinc_model_file).split('.')[0]
         filename = file_basename + '_transformed'
         path = output_directory
         self._output_filename = os.path.join(path, filename)
 
-        # Setting up transformation steps
+        # Running transformation stages: load, align, fit, write
+        with profiler.stage('load', file_basename, input_zinc_model_file):
+            self._load(input_zinc_model_file, input_zinc_data)
+        with profiler.stage('align', file_basename):
+            self._align()
+        if fit_settings['fit'] and not preview:
+            warm_start = False
+            if template_filename:
+                with profiler.stage('warm start', file_basename, template_filename):
+                    warm_start = self._warm_start(template_filename)
+            print("Transforming organ ({}) ... It may take a minute".format(file_basename))
+            with profiler.stage('fit', file_basename):
+                self._fit(fit_settings, warm_start)
+        if preview:
+            transform_filename = self._output_filename + '_preview.json'
+            self._output_filename = self._output_filename + '_preview.exf'
+        else:
+            self._output_filename = self._output_filename + '_fit1.exf'
+        with profiler.stage('write', file_basename, output_file=self._output_filename):
+            self._write_fitted_model(organ_name)
+            if preview:
+                self._write_transform(transform_filename, input_zinc_model_file, organ_name)
+        if store_template_filename and fit_settings['fit'] and not preview:
+            with profiler.stage('write template', file_basename, output_file=store_template_filename):
+                self._write_template(store_template_filename)
+        self.release()
+        print('Transformation is done')
+
+    def release(self):
+        """
+        Release the fitter and its zinc context once the output is written. Fitter steps refer back to the
+        fitter, so it would otherwise only be freed by the cyclic garbage collector.
+        """
+        if self._fitter is not None:
+            self._fitter.cleanup()
+        self._fitter = None
+        self._align_step = None
+        self._currentFitterStep = None
+
+    def _load(self, input_zinc_model_file, input_zinc_data):
+        # Initializing Fitter with input files
+        if isinstance(input_zinc_data, MarkerData):
+            self._fitter = MarkerDataFitter(input_zinc_model_file, input_zinc_data)
+        else:
+            self._fitter = Fitter(input_zinc_model_file, input_zinc_data)
+        self._fitter.load()
+        self.set_model_coordinates_field()
+
+    def _align(self):
         self._currentFitterStep = FitterStepAlign()
         self._fitter.addFitterStep(self._currentFitterStep)
         self._currentFitterStep.setAlignMarkers(True)
-        self._currentFitterStep.run(modelFileNameStem=self._output_filename)
+        self._currentFitterStep.run(modelFileNameStem=None if self._preview else self._output_filename)
+        self._align_step = self._currentFitterStep
+
+    def _write_transform(self, filename, input_zinc_model_file, organ_name):
+        """
+        Write the marker alignment of the organ to a JSON file, including the 4x4 row-major matrix M
+        transforming original organ coordinates p = [x, y, z, 1] to p' = Mp.
+        """
+        rms_error, maximum_error = self._fitter.getDataRMSAndMaximumProjectionError()
+        transform = {
+            'organ': organ_name,
+            'input_file': input_zinc_model_file,
+            'output_file': self._output_filename,
+            'matrix': self._align_step.getTransformationMatrix(),
+            'rotation': list(self._align_step.getRotation()),
+            'scale': self._align_step.getScale(),
+            'translation': list(self._align_step.getTranslation()),
+            'rms_error': rms_error,
+            'maximum_error': maximum_error,
+        }
+        with open(filename + TEMPORARY_SUFFIX, 'w') as f:
+            json.dump(transform, f, indent=4)
+        os.replace(filename + TEMPORARY_SUFFIX, filename)
 
+    def _fit(self, fit_settings, warm_start=False):
+        """
+        Fit the levels in turn. Levels before the last are stiffer pre-fits of the markers, moving the organ
+        towards them without large deformations; the last level fits with the full settings.
+
+        :param warm_start: Set to True if starting from a template, which is already close so only the final
+            level is fitted, with warm_start_iterations.
+        """
+        levels = fit_settings['levels']
+        for level in range(levels - 1 if warm_start else 0, levels):
+            coarseness = levels - 1 - level
+            penalty_factor = fit_settings['level_penalty_factor'] ** coarseness
+            if coarseness:
+                iterations = fit_settings['level_iterations']
+            else:
+                iterations = fit_settings['warm_start_iterations'] if warm_start else fit_settings['iterations']
+            if fit_settings['tolerance'] > 0.0:
+                # run iterations as separate steps to check convergence after each
+                previous_rms_error = self._fitter.getDataRMSAndMaximumProjectionError()[0]
+                for iteration in range(iterations):
+                    self._add_fit_step(fit_settings, penalty_factor, 1)
+                    rms_error = self._fitter.getDataRMSAndMaximumProjectionError()[0]
+                    if (previous_rms_error is None) or (rms_error is None) or \
+                            ((previous_rms_error - rms_error) <= fit_settings['tolerance'] * previous_rms_error):
+                        break
+                    previous_rms_error = rms_error
+            else:
+                self._add_fit_step(fit_settings, penalty_factor, iterations)
+
+    def _warm_start(self, template_filename):
+        """
+        Start the fit from a template of the same organ scaffold fitted for another subject, in the frame of the
+        organ file, by transforming it with this organ's alignment to the markers.
+
+        :return: True if the template was used, False if it could not be read.
+        """
+        region = self._fitter.getRegion()
+        field_module = self._fitter.getFieldmodule()
+        coordinates = self._fitter.getModelCoordinatesField()
+        with ChangeManager(field_module):
+            result = region.readFile(template_filename)
+            template_coordinates = field_module.findFieldByName(TEMPLATE_FIELD_NAME)
+            if (result != RESULT_OK) or not template_coordinates.isValid():
+                print("Failed to read organ template ({}); fitting from the organ file".format(template_filename))
+                return False
+            transformed_coordinates = create_affine_transform_field(
+                template_coordinates, self._align_step.getTransformationMatrix())
+            field_assignment = coordinates.createFieldassignment(transformed_coordinates)
+            field_assignment.setNodeset(field_module.findNodesetByFieldDomainType(Field.DOMAIN_TYPE_NODES))
+            result = field_assignment.assign()
+            del field_assignment
+            del transformed_coordinates
+        assert result in (RESULT_OK, RESULT_WARNING_PART_DONE), "Failed to warm start from " + template_filename
+        self._fitter.calculateDataProjections(self._align_step)
+        return True
+
+    def _write_template(self, filename):
+        """
+        Write the fitted node coordinates, mapped back to the frame of the organ file by the inverse of the
+        alignment, as a template for warm-starting fits of the same organ scaffold.
+        """
+        region = self._fitter.getRegion()
+        field_module = self._fitter.getFieldmodule()
+        coordinates = self._fitter.getModelCoordinatesField()
+        with ChangeManager(field_module):
+            template_coordinates = field_module.findFieldByName(TEMPLATE_FIELD_NAME)
+            if not template_coordinates.isValid():
+                template_coordinates = create_field_finite_element_clone(coordinates, TEMPLATE_FIELD_NAME)
+            untransformed_coordinates = create_affine_transform_field(
+                coordinates, invert_similarity_transform(self._align_step.getTransformationMatrix()))
+            field_assignment = template_coordinates.createFieldassignment(untransformed_coordinates)
+            field_assignment.setNodeset(field_module.findNodesetByFieldDomainType(Field.DOMAIN_TYPE_NODES))
+            result = field_assignment.assign()
+            del field_assignment
+            del untransformed_coordinates
+            assert result in (RESULT_OK, RESULT_WARNING_PART_DONE), "Failed to make organ template"
+            sir = region.createStreaminformationRegion()
+            sir.setRecursionMode(sir.RECURSION_MODE_OFF)
+            srf = sir.createStreamresourceFile(filename)
+            sir.setResourceFieldNames(srf, [TEMPLATE_FIELD_NAME])
+            sir.setResourceDomainTypes(srf, Field.DOMAIN_TYPE_NODES)
+            result = region.write(sir)
+        assert result == RESULT_OK, "Failed to write organ template file " + str(filename)
+
+    def _add_fit_step(self, fit_settings, penalty_factor, iterations):
         self._currentFitterStep = FitterStepFit()
         self._fitter.addFitterStep(self._currentFitterStep)
-        self._currentFitterStep.setGroupStrainPenalty(None, [0.001])
-        self._currentFitterStep.setGroupCurvaturePenalty(None, [200.0])
-        self._currentFitterStep.setGroupDataWeight(None, 1000.0)
-
-        # Running transformation
-        print("Transforming organ ({}) ... It may take a minute".format(file_basename))
-        self._currentFitterStep.run(modelFileNameStem=self._output_filename)
-        self._output_filename = self._output_filename + '_fit1.exf'
-        print('Transformation is done')
+        self._currentFitterStep.setGroupStrainPenalty(None, [fit_settings['strain_penalty'] * penalty_factor])
+        self._currentFitterStep.setGroupCurvaturePenalty(None, [fit_settings['curvature_penalty'] * penalty_factor])
+        self._currentFitterStep.setGroupDataWeight(None, fit_settings['data_weight'])
+        self._currentFitterStep.setNumberOfIterations(iterations)
+        self._currentFitterStep.run()
+
+    def _write_fitted_model(self, organ_name):
+        """
+        Write the fitted model as Fitter.writeModel() does, but also adding and writing the organ group
+        so the output is complete after a single write.
+        """
+        region = self._fitter.getRegion()
+        field_module = self._fitter.getFieldmodule()
+        coordinates = self._fitter.getModelCoordinatesField()
+        coordinates_name = coordinates.getName()
+        output_coordinates_name = "fitted " + coordinates_name
+        with ChangeManager(field_module):
+            # only the resource group is written with recursion off, so the organ group restricted to
+            # the model fit group replaces it
+            output_group = self._fitter.getModelFitGroup()
+            if organ_name:
+                output_group = create_organ_group(field_module, organ_name, output_group)
+            # temporarily rename model coordinates field as for Fitter.writeModel()
+            coordinates.setName(output_coordinates_name)
+            sir = region.createStreaminformationRegion()
+            sir.setRecursionMode(sir.RECURSION_MODE_OFF)
+            # write to a temporary file renamed when complete so a partly written output is never seen
+            temporary_filename = self._output_filename + TEMPORARY_SUFFIX
+            srf = sir.createStreamresourceFile(temporary_filename)
+            sir.setResourceFieldNames(srf, [output_coordinates_name])
+            sir.setResourceDomainTypes(srf, Field.DOMAIN_TYPE_NODES | Field.DOMAIN_TYPE_MESH1D |
+                                       Field.DOMAIN_TYPE_MESH2D | Field.DOMAIN_TYPE_MESH3D)
+            if output_group:
+                sir.setResourceGroupName(srf, output_group.getName())
+            result = region.write(sir)
+            coordinates.setName(coordinates_name)
+        assert result == RESULT_OK, "Failed to write transformed organ file " + str(self._output_filename)
+        os.replace(temporary_filename, self._output_filename)
+
+    @staticmethod
+    def get_output_filename(input_zinc_model_file, output_directory, preview=False):
+        """
+        :return: Name of the file the transformed organ, or its preview, is written to.
+        """
+        file_basename = os.path.basename(input_zinc_model_file).split('.')[0]
+        return os.path.join(output_directory,
+                            file_basename + ('_transformed_preview.exf' if preview else '_transformed_fit1.exf'))
 
     # Method to set model coordinates field
     def set_model_coordinates_field(self):
@@ -147,7 +1329,14 @@ class OrganTransformer(BaseOutputFile):
 
 # Class for handling marker coordinates
 class MarkerCoordinates(BaseOutputFile):
-    def __init__(self, input_scaffold_file, output_directory):
+    def __init__(self, input_scaffold_file, output_directory=None, profiler=None):
+        """
+        Evaluate coordinates of the markers embedded in the scaffold into MarkerData.
+
+        :param input_scaffold_file: Scaffold file with embedded markers.
+        :param output_directory: If set, also write marker coordinates to an .exnode file in this directory.
+        :param profiler: Optional StageProfiler to record stage events with.
+        """
         super().__init__()
         # Creating context and region
         self._context = Context('markerBodyCoordinates')
@@ -156,13 +1345,29 @@ class MarkerCoordinates(BaseOutputFile):
         self._field_module = self._region.getFieldmodule()
         self._scaffold_file = input_scaffold_file
         self._model_coordinates_field = None
-        self._marker_region = None
+        self._marker_data = MarkerData(source_filename=input_scaffold_file)
 
         # Loading scaffold file and discovering coordinate fields
-        self._load()
-        self._get_marker_coordinates()
-        marker_region = self._get_marker_region()
-        self._save(marker_region, output_directory)
+        profiler = profiler if profiler else StageProfiler()
+        with profiler.stage('load whole body', input_file=input_scaffold_file):
+            self._load()
+        with profiler.stage('marker coordinates'):
+            self._get_marker_coordinates()
+        if output_directory:
+            self.save(output_directory)
+
+    def marker_data(self):
+        return self._marker_data
+
+    def release(self):
+        """
+        Release the zinc context holding the scaffold. Only the marker data is kept.
+        """
+        self._field_module = None
+        self._mesh = None
+        self._model_coordinates_field = None
+        self._region = None
+        self._context = None
 
     def _discover_coordinate_fields(self):
         field = None
@@ -224,13 +1429,26 @@ class MarkerCoordinates(BaseOutputFile):
         self._mesh = [self._field_module.findMeshByDimension(d + 1) for d in range(3)]
         self._discover_coordinate_fields()
 
-    def _save(self, region, output_directory):
-        filename = os.path.basename(self._scaffold_file).split('.')[0] + '_marker_coordinates.exnode'
-        path = output_directory
-        self._output_filename = os.path.join(path, filename)
-        region.writeFile(self._output_filename)
+    def save(self, output_directory):
+        self._output_filename = self.write_marker_file(self._scaffold_file, self._marker_data, output_directory)
+
+    @staticmethod
+    def write_marker_file(scaffold_file, marker_data, output_directory):
+        """
+        Write marker_data evaluated from scaffold_file to an .exnode file in output_directory.
+
+        :return: Name of the marker file.
+        """
+        filename = os.path.basename(scaffold_file).split('.')[0] + '_marker_coordinates.exnode'
+        output_filename = os.path.join(output_directory, filename)
+        marker_data.write_file(output_filename)
+        return output_filename
 
     def _get_marker_coordinates(self):
+        """
+        Evaluate all marker coordinates in one pass: the embedded coordinates are assigned to a temporary
+        field on the union of marker nodes with a single field assignment, then read back in bulk.
+        """
         field_cache = self._field_module.createFieldcache()
         nodes = self._field_module.findNodesetByFieldDomainType(Field.DOMAIN_TYPE_NODES)
 
@@ -239,55 +1457,48 @@ class MarkerCoordinates(BaseOutputFile):
         markerLocation = self._field_module.findFieldByName(marker_location_name)
         markerName = self._field_module.findFieldByName(marker_name)
         # markerGroup = self._field_module.findFieldByName(marker_group_name)
+        if not (markerLocation.isValid() and markerName.isValid()):
+            return
 
-        self._marker_region = self._region.createRegion()
-        marker_fieldmodule = self._marker_region.getFieldmodule()
-        temp_nodes = marker_fieldmodule.findNodesetByFieldDomainType(Field.DOMAIN_TYPE_NODES)
-        marker_fieldCache = marker_fieldmodule.createFieldcache()
-        marker_data_coordinates = findOrCreateFieldCoordinates(marker_fieldmodule, name="marker_data_coordinates",
-                                                               components_count=3)
-        marker_data_name = findOrCreateFieldStoredString(marker_fieldmodule, name="marker_data_name")
-        marker_data_group = findOrCreateFieldGroup(marker_fieldmodule, name="marker")
-        marker_data_nodesGroup = marker_data_group.createNodesetGroup(temp_nodes)
-
-        markerTemplateInternal = temp_nodes.createNodetemplate()
-        markerTemplateInternal.defineField(marker_data_name)
-        markerTemplateInternal.defineField(marker_data_coordinates)
-        markerTemplateInternal.setValueNumberOfVersions(marker_data_coordinates, -1, Node.VALUE_LABEL_VALUE, 1)
-
-        for marker_group_name in marker_group_names:
-            markerGroup = self._field_module.findFieldByName(marker_group_name)
-            markerNodes = None
-            if markerGroup.isValid():
-                markerGroup = markerGroup.castGroup()
-                markerNodes = markerGroup.getNodesetGroup(nodes)
-
-            if markerLocation.isValid() and markerName.isValid():
-                with ChangeManager(marker_fieldmodule):
-                    marker_coordinates = self._field_module.createFieldEmbedded(self._model_coordinates_field,
-                                                                                markerLocation)
-                    nodeIter = markerNodes.createNodeiterator()
-                    node = nodeIter.next()
-                    while node.isValid():
-                        marker_node = temp_nodes.createNode(node.getIdentifier(), markerTemplateInternal)
-                        marker_data_nodesGroup.addNode(marker_node)
-
-                        marker_fieldCache.setNode(marker_node)
-                        field_cache.setNode(node)
-                        result, x = marker_coordinates.evaluateReal(field_cache, 3)
-                        result = marker_data_coordinates.setNodeParameters(marker_fieldCache, -1,
-                                                                           Node.VALUE_LABEL_VALUE, 1, x)
-                        if result == RESULT_OK:
-                            name = markerName.evaluateString(field_cache)
-                            if name:
-                                marker_data_name.assignString(marker_fieldCache, name)
-                        node = nodeIter.next()
+        identifiers = []
+        names = []
+        with ChangeManager(self._field_module):
+            # markers in more than one group are only added once
+            marker_coordinates = self._field_module.createFieldEmbedded(self._model_coordinates_field,
+                                                                        markerLocation)
+            all_markers_group = self._field_module.createFieldGroup()
+            all_marker_nodes = all_markers_group.createNodesetGroup(nodes)
+            is_evaluable = self._field_module.createFieldIsDefined(marker_coordinates)
+            for marker_group_name in marker_group_names:
+                markerGroup = self._field_module.findFieldByName(marker_group_name).castGroup()
+                if markerGroup.isValid():
+                    all_marker_nodes.addNodesConditional(self._field_module.createFieldAnd(markerGroup, is_evaluable))
+
+            marker_data_coordinates = self._field_module.createFieldFiniteElement(3)
+            node_template = nodes.createNodetemplate()
+            node_template.defineField(marker_data_coordinates)
+            nodeIter = all_marker_nodes.createNodeiterator()
+            node = nodeIter.next()
+            while node.isValid():
+                node.merge(node_template)
+                field_cache.setNode(node)
+                identifiers.append(node.getIdentifier())
+                names.append(markerName.evaluateString(field_cache))
+                node = nodeIter.next()
+            if not identifiers:
+                return
+            field_assignment = marker_data_coordinates.createFieldassignment(marker_coordinates)
+            field_assignment.setNodeset(all_marker_nodes)
+            result = field_assignment.assign()
+            assert result == RESULT_OK, "Failed to evaluate marker coordinates"
+            # parameters are in node identifier order, as iterated above
+            field_parameters = marker_data_coordinates.getFieldparameters()
+            result, coordinates = field_parameters.getParameters(field_parameters.getNumberOfParameters())
+            assert result == RESULT_OK, "Failed to get marker coordinates"
+        self._marker_data = MarkerData(identifiers, coordinates, names, source_filename=self._scaffold_file)
 
     def _set_model_coordinates_field(self, model_coordinates_field: Field):
         finite_element_field = model_coordinates_field.castFiniteElement()
         assert finite_element_field.isValid() and (finite_element_field.getNumberOfComponents() == 3)
         self._model_coordinates_field = finite_element_field
 
-    def _get_marker_region(self):
-        return self._marker_region
-
@@ -0,0 +1,120 @@
+import json
+import logging
+import os
+import sys
+import time
+
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+PROFILE_FILENAME = 'organinserter_profile.json'
+
+
+def peak_memory():
+    """
+    :return: Peak resident memory of this process so far in bytes, or None if not available.
+    """
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def file_size(filename):
+    """
+    :return: Size of file in bytes, or None if filename is not an existing file.
+    """
+    if filename and isinstance(filename, str) and os.path.isfile(filename):
+        return os.path.getsize(filename)
+    return None
+
+
+class StageProfiler(object):
+    """
+    Records an event for each stage of organ insertion with its elapsed time, peak memory and file sizes.
+    Each event is a dict with keys stage, organ, elapsed (seconds), peak_memory (bytes, for the process the
+    stage ran in), input_size and output_size (bytes or None), and pid.
+    Events are logged at debug level to this module's logger and passed to the optional callback.
+    Picklable so it can be passed to worker processes; the callback is not passed on.
+    """
+
+    def __init__(self, event_callback=None):
+        """
+        :param event_callback: Optional callable(event) called as each stage finishes.
+        """
+        self._event_callback = event_callback
+        self._events = []
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_event_callback'] = None
+        return state
+
+    @contextmanager
+    def stage(self, stage, organ=None, input_file=None, output_file=None):
+        """
+        Context manager recording an event for the enclosed stage, after it completes without error.
+
+        :param stage: Name of the stage.
+        :param organ: Name of the organ, or None if not for a single organ.
+        :param input_file: Optional name of file read by the stage.
+        :param output_file: Optional name of file written by the stage.
+        """
+        start = time.perf_counter()
+        yield
+        self.add_event({
+            'stage': stage,
+            'organ': organ,
+            'elapsed': time.perf_counter() - start,
+            'peak_memory': peak_memory(),
+            'input_size': file_size(input_file),
+            'output_size': file_size(output_file),
+            'pid': os.getpid(),
+        })
+
+    def add_event(self, event):
+        self._events.append(event)
+        logger.debug("%s%s: %.3f s", event['stage'], " ({})".format(event['organ']) if event['organ'] else "",
+                     event['elapsed'])
+        if self._event_callback:
+            self._event_callback(event)
+
+    def get_events(self):
+        return self._events
+
+    def summary(self):
+        """
+        :return: dict with all events, the total elapsed time per stage and per organ, and the peak memory
+            of the process each organ was transformed in. Peak memory is only for the organ itself if it was
+            the only organ transformed in its process, as in low memory mode.
+        """
+        stage_totals = {}
+        organ_totals = {}
+        organ_peak_memory = {}
+        for event in self._events:
+            stage_totals[event['stage']] = stage_totals.get(event['stage'], 0.0) + event['elapsed']
+            if event['organ']:
+                organ_totals[event['organ']] = organ_totals.get(event['organ'], 0.0) + event['elapsed']
+                if event['peak_memory'] is not None:
+                    organ_peak_memory[event['organ']] = max(organ_peak_memory.get(event['organ'], 0),
+                                                            event['peak_memory'])
+        return {
+            'stage_totals': stage_totals,
+            'organ_totals': organ_totals,
+            'organ_peak_memory': organ_peak_memory,
+            'events': self._events,
+        }
+
+    def write(self, filename):
+        """
+        Write summary() to a JSON file.
+        """
+        with open(filename, 'w') as f:
+            json.dump(self.summary(), f, indent=4)
@@ -1,8 +1,9 @@
 import csv
 import os
 
-from PySide6 import QtCore, QtGui, QtWidgets
+from PySide6 import QtCore, QtWidgets
 
+from mapclientplugins.organinserterstep.organregistry import get_organ_registry
 from mapclientplugins.organinserterstep.ui_organinserterwidget import Ui_OrganInserterWidget
 
 
@@ -17,65 +18,239 @@ class OrganInserterWidget(QtWidgets.QWidget):
         self._ui = Ui_OrganInserterWidget()
         self._ui.setupUi(self)
         self._callback = None
+        self._cancel_callback = None
 
         self.setTableViewOrganFiles()
         self._ui.pushButtonDone.clicked.connect(self._done_button_clicked)
+        self._ui.pushButtonCancel.clicked.connect(self._cancel_button_clicked)
 
     def setTableViewOrganFiles(self):
-        self._ui.tableViewOrganFiles.setRowCount(len(self._input_data_files))
-        self._ui.tableViewOrganFiles.setColumnCount(2)
-        self._ui.tableViewOrganFiles.setHorizontalHeaderLabels(["Filename", "Organ"])
+        self._model = OrganFileModel(self._input_data_files, self)
+        self._proxy_model = QtCore.QSortFilterProxyModel(self)
+        self._proxy_model.setSourceModel(self._model)
+        self._proxy_model.setFilterCaseSensitivity(QtCore.Qt.CaseSensitivity.CaseInsensitive)
+        self._proxy_model.setFilterKeyColumn(-1)
+        self._ui.tableViewOrganFiles.setModel(self._proxy_model)
+        self._ui.tableViewOrganFiles.setItemDelegateForColumn(1, ComboBoxDelegate(self._ui.tableViewOrganFiles))
+        self._ui.tableViewOrganFiles.setSortingEnabled(True)
+        self._ui.tableViewOrganFiles.sortByColumn(-1, QtCore.Qt.SortOrder.AscendingOrder)
+        self._ui.tableViewOrganFiles.setEditTriggers(QtWidgets.QAbstractItemView.EditTrigger.AllEditTriggers)
         header = self._ui.tableViewOrganFiles.horizontalHeader()
-        header.setSectionResizeMode(0, QtWidgets.QHeaderView.ResizeMode.ResizeToContents)
+        header.setSectionResizeMode(0, QtWidgets.QHeaderView.ResizeMode.Interactive)
         header.setSectionResizeMode(1, QtWidgets.QHeaderView.ResizeMode.Stretch)
-        # header.setSectionResizeMode(2, QtWidgets.QHeaderView.ResizeMode.ResizeToContents)
-        self._ui.tableViewOrganFiles.setItemDelegateForColumn(1, ComboBoxDelegate(self._ui.tableViewOrganFiles))
-        for i in range(len(self._input_data_files)):
-            item_name = QtWidgets.QTableWidgetItem(self._input_data_files[i])
-            self._ui.tableViewOrganFiles.setItem(i, 0, item_name)
-        self._ui.tableViewOrganFiles.setItemDelegateForColumn(1, ComboBoxDelegate(self._ui.tableViewOrganFiles))
+        header.resizeSection(0, 300)
+        self._ui.comboBoxOrgan.addItems(self._model.get_organ_names())
+        self._ui.lineEditFilter.textChanged.connect(self._filter_changed)
+        self._ui.pushButtonAssign.clicked.connect(self._assign_button_clicked)
+        self._ui.pushButtonClassify.clicked.connect(self._classify_button_clicked)
+
+    def _filter_changed(self, text):
+        if text:
+            # filter all rows, not only those loaded so far
+            self._model.fetch_all()
+        self._proxy_model.setFilterFixedString(text)
+
+    def _get_selected_rows(self):
+        """
+        :return: Model rows of the selected files, or of all files shown if none are selected.
+        """
+        indexes = self._ui.tableViewOrganFiles.selectionModel().selectedRows()
+        if not indexes:
+            indexes = [self._proxy_model.index(row, 0) for row in range(self._proxy_model.rowCount())]
+        return [self._proxy_model.mapToSource(index).row() for index in indexes]
+
+    def _assign_button_clicked(self):
+        self._model.set_organ(self._get_selected_rows(), self._ui.comboBoxOrgan.currentText())
+
+    def _classify_button_clicked(self):
+        self._model.classify(self._get_selected_rows())
 
     def register_done_execution(self, callback):
         self._callback = callback
 
+    def register_cancel_execution(self, callback):
+        self._cancel_callback = callback
+
+    def set_progress(self, filename, finished_count, total_count):
+        self._ui.labelProgress.setText("Inserted {} of {} organs ({})".format(
+            finished_count, total_count, os.path.basename(filename)))
+
+    def set_message(self, message):
+        self._ui.labelProgress.setText(message)
+
+    def set_running(self, running):
+        """
+        Enable cancel and disable editing while organs are being inserted in the background.
+        """
+        self._ui.pushButtonDone.setEnabled(not running)
+        self._ui.pushButtonCancel.setEnabled(running)
+        self._ui.tableViewOrganFiles.setEnabled(not running)
+        self._ui.lineEditFilter.setEnabled(not running)
+        self._ui.comboBoxOrgan.setEnabled(not running)
+        self._ui.pushButtonAssign.setEnabled(not running)
+        self._ui.pushButtonClassify.setEnabled(not running)
+        if running:
+            self._ui.labelProgress.setText("Inserting organs ...")
+
+    def _cancel_button_clicked(self):
+        self._ui.pushButtonCancel.setEnabled(False)
+        self._ui.labelProgress.setText("Cancelling ...")
+        if self._cancel_callback:
+            self._cancel_callback()
+
     def _done_button_clicked(self):
-        QtWidgets.QApplication.setOverrideCursor(QtCore.Qt.CursorShape.WaitCursor)
-        organ_file_dict = {}
-        for row in range(self._ui.tableViewOrganFiles.rowCount()):
-            # item(row, 0) Returns the item for the given row and column if one has been set; otherwise returns nullptr.
-            _item = self._ui.tableViewOrganFiles.item(row, 1)
-            if _item and _item.text() != '-':
-                organ_file_dict[_item.text()] = self._ui.tableViewOrganFiles.item(row, 0).text()
+        organ_file_dict, collisions = self._model.get_organ_file_dict()
+        if collisions:
+            # each organ can only be inserted from one file, so report rather than drop the others
+            self.set_message("Choose one file for each organ: " + "; ".join(
+                "{} is chosen for {}".format(organ_name, ", ".join(os.path.basename(name) for name in filenames))
+                for organ_name, filenames in collisions.items()))
+            return
         print(organ_file_dict)
         # organ_file_dict = {'lung': 'C:\\Users\\ywan787\\mapclient_workflows\\organinster\\output_Retrieve_Portal_Data\\brainstem.exf',
         #                    'heart': 'C:\\Users\\ywan787\\mapclient_workflows\\organinster\\output_Retrieve_Portal_Data\\heart.exf',
         #                    'whole body': 'C:\\Users\\ywan787\\mapclient_workflows\\organinster\\output_Retrieve_Portal_Data\\whole-body.exf'}
         self._callback(organ_file_dict)
-        QtWidgets.QApplication.restoreOverrideCursor()
+
+
+class OrganFileModel(QtCore.QAbstractTableModel):
+    """
+    Table of files and the organ each is inserted as, '-' for files not inserted. Rows are made available to views
+    in batches as they scroll, and each file is only classified from its name when its organ is first shown, so
+    large file lists open quickly and painting never reads files. Files whose names do not match an organ are
+    only classified from the groups in them by classify(), from the Classify button.
+    """
+
+    BATCH_SIZE = 100
+
+    def __init__(self, filenames, parent=None):
+        super(OrganFileModel, self).__init__(parent)
+        self._filenames = list(filenames)
+        # organ name per row, None until classified
+        self._organs = [None] * len(self._filenames)
+        self._row_count = 0
+        registry = get_organ_registry()
+        self._organ_names = ['-', registry.get_whole_body_name()] + registry.get_organ_names()
+
+    def get_organ_names(self):
+        """
+        :return: List of organ names which can be chosen, starting with '-' for not inserted.
+        """
+        return self._organ_names
+
+    def _get_organ(self, row):
+        """
+        :return: Organ of row, classified from its file name only if not yet known.
+        """
+        if self._organs[row] is None:
+            self._organs[row] = get_organ_registry().match_file_name(self._filenames[row]) or '-'
+        return self._organs[row]
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else self._row_count
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else 2
+
+    def canFetchMore(self, parent=QtCore.QModelIndex()):
+        return (not parent.isValid()) and (self._row_count < len(self._filenames))
+
+    def fetchMore(self, parent=QtCore.QModelIndex()):
+        count = min(self.BATCH_SIZE, len(self._filenames) - self._row_count)
+        self.beginInsertRows(QtCore.QModelIndex(), self._row_count, self._row_count + count - 1)
+        self._row_count += count
+        self.endInsertRows()
+
+    def fetch_all(self):
+        if self.canFetchMore():
+            self.beginInsertRows(QtCore.QModelIndex(), self._row_count, len(self._filenames) - 1)
+            self._row_count = len(self._filenames)
+            self.endInsertRows()
+
+    def headerData(self, section, orientation, role=QtCore.Qt.ItemDataRole.DisplayRole):
+        if (orientation == QtCore.Qt.Orientation.Horizontal) and (role == QtCore.Qt.ItemDataRole.DisplayRole):
+            return ["Filename", "Organ"][section]
+        return None
+
+    def data(self, index, role=QtCore.Qt.ItemDataRole.DisplayRole):
+        if index.isValid() and (role in (QtCore.Qt.ItemDataRole.DisplayRole, QtCore.Qt.ItemDataRole.EditRole)):
+            return self._filenames[index.row()] if index.column() == 0 else self._get_organ(index.row())
+        return None
+
+    def setData(self, index, value, role=QtCore.Qt.ItemDataRole.EditRole):
+        if index.isValid() and (index.column() == 1) and (role == QtCore.Qt.ItemDataRole.EditRole) and \
+                (value in self._organ_names):
+            self._organs[index.row()] = value
+            self.dataChanged.emit(index, index, [role])
+            return True
+        return False
+
+    def flags(self, index):
+        flags = super(OrganFileModel, self).flags(index)
+        return (flags | QtCore.Qt.ItemFlag.ItemIsEditable) if index.column() == 1 else flags
+
+    def _organs_changed(self, rows):
+        if rows:
+            self.dataChanged.emit(self.index(min(rows), 1), self.index(max(rows), 1))
+
+    def set_organ(self, rows, organ_name):
+        """
+        Set the organ of all of rows to organ_name.
+        """
+        for row in rows:
+            self._organs[row] = organ_name
+        self._organs_changed(rows)
+
+    def classify(self, rows):
+        """
+        Set the organ of rows to that classified from their file names, or the groups in them.
+        """
+        registry = get_organ_registry()
+        for row in rows:
+            self._organs[row] = registry.classify_file(self._filenames[row]) or '-'
+        self._organs_changed(rows)
+
+    def get_organ_file_dict(self):
+        """
+        Organs are as shown or chosen, and files not yet shown are classified from their names only.
+
+        :return: dict organ name -> file for all files with an organ, and dict organ name -> list of files for
+            organs chosen for more than one file.
+        """
+        organ_file_dict = {}
+        collisions = {}
+        for row, filename in enumerate(self._filenames):
+            organ_name = self._get_organ(row)
+            if organ_name != '-':
+                other_filename = organ_file_dict.setdefault(organ_name, filename)
+                if other_filename != filename:
+                    collisions.setdefault(organ_name, [other_filename]).append(filename)
+        return organ_file_dict, collisions
 
 
 class ComboBoxDelegate(QtWidgets.QStyledItemDelegate):
-    def __init__(self, parent=None):
-        super(ComboBoxDelegate, self).__init__(parent)
-        self.organsList = ['-', 'whole body', 'lung', 'heart', 'brainstem', 'stomach', 'bladder']
+    """
+    Chooses the organ with a combo box while editing; cells are otherwise painted as plain text.
+    """
 
     def createEditor(self, widget, option, index):
         editor = QtWidgets.QComboBox(widget)
-        editor.addItems(self.organsList)
+        editor.addItems(get_organ_names(index.model()))
+        # commit as soon as an organ is chosen
+        editor.activated.connect(lambda: self.commitData.emit(editor))
         return editor
 
-    # def setEditorData(self, editor, index):
-    #     editor.setCurrentText(self.organsList[index.row()])
-
-    def paint(self, painter, option, index):
-        # text = self.organsList[index.row()]
-        # option.text = self.organsList[index.row()]
-        # QtWidgets.QApplication.style().drawControl(QtWidgets.QStyle.ControlElement.CE_ItemViewItem, option, painter)
-        # super().paint(painter, option, index)
-
-        value = index.data(QtGui.Qt.ItemDataRole.DisplayRole)
-        opt = QtWidgets.QStyleOptionComboBox()
-        opt.text = str(value)
-        opt.rect = option.rect
-        QtWidgets.QApplication.style().drawComplexControl(QtWidgets.QStyle.ComplexControl.CC_ComboBox, opt, painter)
-        super().paint(painter, option, index)
+    def setEditorData(self, editor, index):
+        editor.setCurrentText(index.data(QtCore.Qt.ItemDataRole.EditRole))
+
+    def setModelData(self, editor, model, index):
+        model.setData(index, editor.currentText(), QtCore.Qt.ItemDataRole.EditRole)
+
+
+def get_organ_names(model):
+    """
+    :return: Organ names of the OrganFileModel under any proxy models.
+    """
+    while isinstance(model, QtCore.QAbstractProxyModel):
+        model = model.sourceModel()
+    return model.get_organ_names()
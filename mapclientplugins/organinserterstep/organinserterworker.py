@@ -0,0 +1,54 @@
+import threading
+
+from PySide6 import QtCore
+
+from mapclientplugins.organinserterstep.organinsertermodel import OrganInserter
+
+
+class OrganInserterWorker(QtCore.QThread):
+    """
+    Runs OrganInserter on a background thread so the GUI stays responsive.
+    Emits organInserted as each organ finishes; the inherited finished signal is emitted when the job ends.
+    """
+
+    organInserted = QtCore.Signal(str, int, int)  # input data file, finished count, total count
+
+    def __init__(self, input_model_file, input_data_files, output_directory, parent=None, **kwargs):
+        """
+        :param kwargs: Additional keyword arguments passed to OrganInserter.
+        """
+        super(OrganInserterWorker, self).__init__(parent)
+        self._input_model_file = input_model_file
+        self._input_data_files = input_data_files
+        self._output_directory = output_directory
+        self._kwargs = kwargs
+        self._cancel_event = threading.Event()
+        self._organ_inserter = None
+        self._error = None
+
+    def run(self):
+        try:
+            self._organ_inserter = OrganInserter(self._input_model_file, self._input_data_files,
+                                                 self._output_directory, progress_callback=self.organInserted.emit,
+                                                 cancel_event=self._cancel_event, **self._kwargs)
+        except Exception as e:
+            self._error = str(e)
+            print("Organ insertion failed: {}".format(e))
+
+    def cancel(self):
+        """
+        Skip organs not yet started. Organs being transformed run to completion.
+        """
+        self._cancel_event.set()
+
+    def is_cancelled(self):
+        return self._cancel_event.is_set()
+
+    def get_organ_inserter(self):
+        """
+        :return: OrganInserter after the job has finished, or None if it failed.
+        """
+        return self._organ_inserter
+
+    def get_error(self):
+        return self._error
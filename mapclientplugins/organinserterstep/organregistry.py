@@ -0,0 +1,119 @@
+"""
+Registry of the whole body and organs which can be inserted, read from organs.json.
+"""
+import functools
+import json
+import os
+import re
+
+from mapclientplugins.organinserterstep.organinputscan import scan_ex_file
+
+REGISTRY_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'organs.json')
+
+
+def normalize_organ_name(name):
+    """
+    :return: Name ignoring case and treating spaces, underscores and dashes between words the same.
+    """
+    return ' '.join(re.split(r'[\s_-]+', name.strip().casefold())).strip()
+
+
+class OrganRegistry(object):
+    """
+    Names, aliases and data sources of the whole body and organs, and whether each organ is fitted to the whole-body
+    markers or only grouped. Classifies files from their names, or from the groups in them.
+    """
+
+    def __init__(self, registry):
+        """
+        :param registry: dict with 'whole_body' entry and list of 'organs' entries, each with 'name', 'aliases'
+            and 'source', and for organs 'fit', as in organs.json.
+        """
+        self._whole_body = registry['whole_body']
+        self._organs = registry['organs']
+        self._entries = {entry['name']: entry for entry in [self._whole_body] + self._organs}
+        self._names = {}
+        for entry in self._entries.values():
+            for name in [entry['name']] + entry.get('aliases', []):
+                self._names[normalize_organ_name(name)] = entry['name']
+        # one pattern matching any name or alias in a file name, trying longer names first
+        self._file_name_pattern = re.compile('|'.join(
+            r'[\s_-]*'.join(re.escape(word) for word in name.split(' '))
+            for name in sorted(self._names, key=len, reverse=True)))
+
+    @classmethod
+    def read(cls, filename=REGISTRY_FILENAME):
+        with open(filename) as f:
+            return cls(json.load(f))
+
+    def get_whole_body_name(self):
+        return self._whole_body['name']
+
+    def get_organ_names(self, fit_only=False):
+        """
+        :param fit_only: Set to True to only get organs which are fitted to the markers.
+        :return: List of organ names, not including the whole body.
+        """
+        return [organ['name'] for organ in self._organs if organ['fit'] or not fit_only]
+
+    def get_source(self, name):
+        """
+        :return: Source of the scaffold for the whole body or organ, or None if not known.
+        """
+        entry = self._entries.get(name)
+        return entry.get('source') if entry else None
+
+    def is_fitted(self, name):
+        """
+        :return: True if the organ is fitted to the markers. Organs not in the registry are fitted.
+        """
+        entry = self._entries.get(name)
+        return entry.get('fit', True) if entry else True
+
+    def match_file_name(self, filename):
+        """
+        :return: Name of the whole body or organ first found in the base name of filename, or None if none.
+        """
+        match = self._file_name_pattern.search(os.path.basename(filename).split('.')[0].casefold())
+        return self._names[normalize_organ_name(match.group(0))] if match else None
+
+    def match_group_names(self, group_names):
+        """
+        :return: Name of the whole body if any group is named for it, otherwise the organ if exactly one organ
+            has groups named for it, otherwise None.
+        """
+        names = set(self._names.get(normalize_organ_name(group_name)) for group_name in group_names)
+        names.discard(None)
+        if self.get_whole_body_name() in names:
+            return self.get_whole_body_name()
+        return names.pop() if len(names) == 1 else None
+
+    def classify_file(self, filename):
+        """
+        Classify a file as the whole body or an organ from its name, or if not matched from the names of the groups
+        in it.
+
+        :return: Name of the whole body or organ, or None if not classified.
+        """
+        name = self.match_file_name(filename)
+        if name is None:
+            try:
+                name = self.match_group_names(scan_ex_file(filename)['groups'])
+            except (OSError, ValueError):
+                pass
+        return name
+
+    def get_organ_name(self, filename):
+        """
+        :return: Organ name matched in filename, otherwise the base file name.
+        """
+        name = self.match_file_name(filename)
+        return name if name else os.path.basename(filename).split('.')[0]
+
+
+@functools.lru_cache(maxsize=None)
+def get_organ_registry():
+    """
+    :return: OrganRegistry read from organs.json, read once.
+    """
+    return OrganRegistry.read()
@@ -0,0 +1,157 @@
+import hashlib
+import json
+import os
+import shutil
+
+# Increment when the content of cached outputs changes so old entries are not reused.
+CACHE_FORMAT_VERSION = 1
+OUTPUT_EXTENSION = '.exf'
+MARKER_DATA_EXTENSION = '.markers'
+
+
+def hash_file(filename, hasher=None):
+    """
+    Update hasher with the content of the file, read in blocks.
+
+    :return: The hasher; a new sha256 hasher if none supplied.
+    """
+    if hasher is None:
+        hasher = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            hasher.update(block)
+    return hasher
+
+
+def evict_least_recently_used(directory, extensions, max_entries, max_bytes):
+    """
+    Remove least recently used files with any of extensions from directory until within the entry count and
+    size limits. Files are marked as used by updating their modification time.
+    """
+    if not os.path.isdir(directory):
+        return
+    entries = []
+    for name in os.listdir(directory):
+        if name.endswith(extensions):
+            stat = os.stat(os.path.join(directory, name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+    entries.sort(reverse=True)
+    total_bytes = 0
+    for count, (mtime, size, name) in enumerate(entries):
+        total_bytes += size
+        if (count >= max_entries) or (total_bytes > max_bytes):
+            os.remove(os.path.join(directory, name))
+
+
+class OrganResultCache(object):
+    """
+    On-disk cache of transformed organ output files, keyed by a hash of the organ file content,
+    the marker data it was fitted to and the fit settings. Marker data evaluated from whole-body scaffolds
+    is also kept, in binary form keyed by a hash of the scaffold file content.
+    Least recently used entries are evicted when the number or total size of entries exceeds the limits.
+    """
+
+    def __init__(self, directory, max_entries=64, max_bytes=2 * 1024 ** 3, force_refit=False):
+        """
+        :param directory: Directory to store cached outputs in. Created on first store.
+        :param max_entries: Maximum number of cached outputs to keep.
+        :param max_bytes: Maximum total size of cached outputs to keep.
+        :param force_refit: Set to True to never reuse cached outputs; new outputs are still stored.
+        """
+        self._directory = directory
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._force_refit = force_refit
+
+    def get_directory(self):
+        return self._directory
+
+    def is_force_refit(self):
+        return self._force_refit
+
+    def key(self, organ_file, organ_name, marker_data, fit_settings):
+        """
+        :param organ_file: Organ scaffold file to transform.
+        :param organ_name: Name of the organ group added to the output.
+        :param marker_data: MarkerData the organ is fitted to.
+        :param fit_settings: dict of fit settings.
+        :return: Hex digest identifying the transformed output.
+        """
+        hasher = hash_file(organ_file)
+        hasher.update(json.dumps([CACHE_FORMAT_VERSION, organ_name, fit_settings], sort_keys=True).encode())
+        hasher.update(marker_data.get_identifiers().tobytes())
+        hasher.update(marker_data.get_coordinates().tobytes())
+        hasher.update('\n'.join(marker_data.get_names()).encode())
+        return hasher.hexdigest()
+
+    @staticmethod
+    def marker_data_key(scaffold_file):
+        """
+        :param scaffold_file: Whole-body scaffold file the marker data is evaluated from.
+        :return: Hex digest identifying the marker data.
+        """
+        hasher = hash_file(scaffold_file)
+        hasher.update(json.dumps([CACHE_FORMAT_VERSION, 'marker data']).encode())
+        return hasher.hexdigest()
+
+    def _entry_filename(self, key, extension=OUTPUT_EXTENSION):
+        return os.path.join(self._directory, key + extension)
+
+    def fetch(self, key, output_filename):
+        """
+        Copy cached output for key to output_filename.
+
+        :return: True if found in the cache, otherwise False.
+        """
+        if self._force_refit:
+            return False
+        entry_filename = self._entry_filename(key)
+        if not os.path.isfile(entry_filename):
+            return False
+        temporary_filename = output_filename + '.tmp'
+        shutil.copyfile(entry_filename, temporary_filename)
+        os.replace(temporary_filename, output_filename)
+        # mark as most recently used
+        os.utime(entry_filename)
+        return True
+
+    def store(self, key, output_filename):
+        """
+        Copy output_filename into the cache under key. Safe to call from several processes.
+        """
+        os.makedirs(self._directory, exist_ok=True)
+        entry_filename = self._entry_filename(key)
+        temporary_filename = entry_filename + '.{}.tmp'.format(os.getpid())
+        shutil.copyfile(output_filename, temporary_filename)
+        os.replace(temporary_filename, entry_filename)
+
+    def fetch_marker_data(self, key):
+        """
+        :return: MarkerData cached under key, or None if not found.
+        """
+        if self._force_refit:
+            return None
+        entry_filename = self._entry_filename(key, MARKER_DATA_EXTENSION)
+        if not os.path.isfile(entry_filename):
+            return None
+        from mapclientplugins.organinserterstep.organinsertermodel import MarkerData
+        marker_data = MarkerData.read_binary(entry_filename)
+        os.utime(entry_filename)
+        return marker_data
+
+    def store_marker_data(self, key, marker_data):
+        """
+        Write marker_data into the cache under key. Safe to call from several processes.
+        """
+        os.makedirs(self._directory, exist_ok=True)
+        entry_filename = self._entry_filename(key, MARKER_DATA_EXTENSION)
+        temporary_filename = entry_filename + '.{}.tmp'.format(os.getpid())
+        marker_data.write_binary(temporary_filename)
+        os.replace(temporary_filename, entry_filename)
+
+    def evict(self):
+        """
+        Remove least recently used entries until within the entry count and size limits.
+        """
+        evict_least_recently_used(self._directory, (OUTPUT_EXTENSION, MARKER_DATA_EXTENSION), self._max_entries,
+                                  self._max_bytes)
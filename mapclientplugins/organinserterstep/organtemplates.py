@@ -0,0 +1,79 @@
+import json
+import os
+
+from mapclientplugins.organinserterstep.organresultcache import evict_least_recently_used, hash_file
+
+# Increment when the content of templates changes so old templates are not used.
+TEMPLATE_FORMAT_VERSION = 1
+TEMPLATE_EXTENSION = '.exnode'
+# Name of the node field holding template coordinates in template files.
+TEMPLATE_FIELD_NAME = 'template coordinates'
+
+
+class OrganTemplateLibrary(object):
+    """
+    On-disk library of fitted organ shapes to warm-start fits of the same organ scaffold for later subjects,
+    keyed by organ name and a hash of the organ file content. A template holds the fitted node coordinates
+    mapped back to the frame of the organ file by the inverse of the organ's alignment to its subject's
+    markers, so after aligning to the next subject's markers the fit starts from the previous fitted shape.
+    Each fit replaces the template for its organ, so fits through a cohort start from the last subject.
+    Least recently used templates are evicted when the number or total size of templates exceeds the limits.
+    """
+
+    def __init__(self, directory, max_entries=32, max_bytes=512 * 1024 ** 2):
+        """
+        :param directory: Directory to store templates in. Created on first store.
+        :param max_entries: Maximum number of templates to keep.
+        :param max_bytes: Maximum total size of templates to keep.
+        """
+        self._directory = directory
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+
+    def get_directory(self):
+        return self._directory
+
+    @staticmethod
+    def key(organ_file, organ_name):
+        """
+        :param organ_file: Organ scaffold file, whose nodes the template gives coordinates for.
+        :param organ_name: Name of the organ.
+        :return: Hex digest identifying templates for the organ scaffold.
+        """
+        hasher = hash_file(organ_file)
+        hasher.update(json.dumps([TEMPLATE_FORMAT_VERSION, organ_name]).encode())
+        return hasher.hexdigest()
+
+    def _entry_filename(self, key):
+        return os.path.join(self._directory, key + TEMPLATE_EXTENSION)
+
+    def fetch(self, key):
+        """
+        :return: Name of the template file for key, or None if not found.
+        """
+        entry_filename = self._entry_filename(key)
+        if not os.path.isfile(entry_filename):
+            return None
+        # mark as most recently used
+        os.utime(entry_filename)
+        return entry_filename
+
+    def get_store_filename(self, key):
+        """
+        :return: Temporary name to write a new template for key to, before calling store().
+            Unique to this process so several processes can write templates at once.
+        """
+        os.makedirs(self._directory, exist_ok=True)
+        return self._entry_filename(key) + '.{}.tmp'.format(os.getpid())
+
+    def store(self, key, template_filename):
+        """
+        Make template_filename, as returned by get_store_filename(), the template for key.
+        """
+        os.replace(template_filename, self._entry_filename(key))
+
+    def evict(self):
+        """
+        Remove least recently used templates until within the entry count and size limits.
+        """
+        evict_least_recently_used(self._directory, (TEMPLATE_EXTENSION,), self._max_entries, self._max_bytes)
@@ -2,23 +2,17 @@
 """
 MAP Client Plugin Step
 """
-import csv
 import json
 import os
 
-from PySide6 import QtCore, QtGui, QtWidgets
-
-from cmlibs.utils.zinc.general import ChangeManager
-from cmlibs.zinc.context import Context
+from PySide6 import QtGui
 
 from mapclient.mountpoints.workflowstep import WorkflowStepMountPoint
-from mapclientplugins.organinserterstep.configuredialog import ConfigureDialog
-from mapclientplugins.organinserterstep.organinserterwidget import OrganInserterWidget
 
-from scaffoldfitter.fitter import Fitter
-from scaffoldfitter.fitterstepalign import FitterStepAlign
-from scaffoldfitter.fitterstepfit import FitterStepFit
-from mapclientplugins.organinserterstep.organinsertermodel import OrganInserter
+from mapclientplugins.organinserterstep.organinserterjournal import file_stamp
+
+# Dialogs, widgets, zinc and scaffoldfitter are imported where used so that
+# MAP Client can discover this plugin without loading them.
 
 class OrganInserterStep(WorkflowStepMountPoint):
     """
@@ -48,9 +42,14 @@ class OrganInserterStep(WorkflowStepMountPoint):
         self._port1_inputZincDataFile = None  # http://physiomeproject.org/workflow/1.0/rdf-schema#file_location
         self._port2_output_marker_data_file = None  # http://physiomeproject.org/workflow/1.0/rdf-schema#file_location
         # Config:
-        self._config = {'identifier': ''}
+        self._config = {'identifier': '', 'workers': 1, 'force_refit': False, 'combined_output': False,
+                        'preview': False, 'low_memory': False, 'fit_settings': {}, 'organ_fit_settings': {},
+                        'organ_records': []}
 
         self._organ_inserter = None
+        self._worker = None
+        self._whole_body_model = None
+        self._organ_file_dict = None
 
     def execute(self):
         """
@@ -59,6 +58,7 @@ class OrganInserterStep(WorkflowStepMountPoint):
         may be connected up to a button in a widget for example.
         """
         # Put your execute step code here before calling the '_doneExecution' method.
+        from mapclientplugins.organinserterstep.organinserterwidget import OrganInserterWidget
         print(self._port0_inputZincModelFile, self._port1_inputZincDataFile)
         self._view = OrganInserterWidget(self._port0_inputZincModelFile, self._port1_inputZincDataFile,
                                              self._location)
@@ -68,12 +68,19 @@ class OrganInserterStep(WorkflowStepMountPoint):
         # self._port2_output_marker_data_file = self._organ_inserter.get_output_file_name()
 
         self._view.register_done_execution(self.doneButtonClicked)
+        self._view.register_cancel_execution(self.cancelButtonClicked)
 
     def doneButtonClicked(self, organ_file_dict):
         # self.write_annotations(self._location)
         input_list = list(organ_file_dict.values())
         input_list.remove(organ_file_dict['whole body'])
         whole_body_model = organ_file_dict['whole body']
+        self._whole_body_model = whole_body_model
+        self._organ_file_dict = organ_file_dict
+        reuse_outputs = self._get_reusable_outputs(whole_body_model, organ_file_dict)
+        if reuse_outputs:
+            print("Skipping unchanged organs: " + ", ".join(
+                organ for organ, file in organ_file_dict.items() if file in reuse_outputs))
         # for i in input_list:
         #     self._fitter = Fitter(whole_body_model, i)
         #     self._fitter.load()
@@ -96,62 +103,113 @@ class OrganInserterStep(WorkflowStepMountPoint):
         #     whole_body_model = self._location + "/fitted.exf"
         # self._organ_inserter = OrganInserter(whole_body_model, input_list,
         #                                      self._location)
-        self._organ_inserter = OrganInserter(whole_body_model, input_list,
-                                             self._location)
-        self._port2_output_marker_data_file = self._organ_inserter.get_output_file_name()
+        # Organs are inserted on a background thread; execution is done when it finishes.
+        from mapclientplugins.organinserterstep.organinserterworker import OrganInserterWorker
+        from mapclientplugins.organinserterstep.organresultcache import OrganResultCache
+        from mapclientplugins.organinserterstep.organtemplates import OrganTemplateLibrary
+        cache = OrganResultCache(os.path.join(self._location, 'organinserter_cache'),
+                                 force_refit=self._config['force_refit'])
+        # fits with the warm_start setting start from the organ's last fit in any earlier execution
+        templates = OrganTemplateLibrary(os.path.join(self._location, 'organinserter_templates'))
+        self._worker = OrganInserterWorker(whole_body_model, input_list, self._location,
+                                           number_of_workers=self._config['workers'], cache=cache,
+                                           write_profile=True, combined_output=self._config['combined_output'],
+                                           reuse_outputs=reuse_outputs, fit_settings=self._config['fit_settings'],
+                                           organ_fit_settings=self._config['organ_fit_settings'],
+                                           preview=self._config['preview'],
+                                           low_memory=self._config['low_memory'], journal=True,
+                                           resume=not self._config['force_refit'], templates=templates,
+                                           organ_names={file: organ for organ, file in organ_file_dict.items()})
+        self._worker.organInserted.connect(self._view.set_progress)
+        self._worker.finished.connect(self._organ_insertion_finished)
+        self._view.set_running(True)
+        self._worker.start()
+
+    def cancelButtonClicked(self):
+        if self._worker:
+            self._worker.cancel()
+
+    def _organ_insertion_finished(self):
+        worker = self._worker
+        self._worker = None
+        self._view.set_running(False)
+        self._organ_inserter = worker.get_organ_inserter()
+        if self._organ_inserter:
+            self._update_organ_records()
+        if worker.is_cancelled() or (self._organ_inserter is None):
+            # stay on the widget so the user can rerun
+            self._view.set_message("Cancelled" if worker.is_cancelled() else "Failed: " + worker.get_error())
+            return
+        errors = self._organ_inserter.get_errors()
+        if errors:
+            # stay on the widget so the user can fix the failed organs and rerun; the others are reused
+            self._view.set_message("Failed: " + "; ".join(
+                "{}: {}".format(os.path.basename(file), error) for file, error in errors.items()))
+            return
+        combined_output_file_name = self._organ_inserter.get_combined_output_file_name()
+        if combined_output_file_name:
+            # downstream steps load a single file containing all organs
+            self._port2_output_marker_data_file = [combined_output_file_name]
+        else:
+            self._port2_output_marker_data_file = self._organ_inserter.get_output_file_name()
+        if self._config['low_memory']:
+            # only the output file names are needed
+            self._organ_inserter = None
         # self._port2_output_marker_data_file = self._location + "/fitted.exf"
         self._doneExecution()
 
+    def _get_reusable_outputs(self, whole_body_model, organ_file_dict):
+        """
+        :return: dict organ file -> output file from a previous execution, for organs whose file, organ label,
+            whole-body scaffold, fit settings and preview mode are unchanged since then.
+        """
+        if self._config['force_refit']:
+            return {}
+        whole_body_stamp = file_stamp(whole_body_model)
+        reuse_outputs = {}
+        for record in self._config['organ_records']:
+            organ_file = organ_file_dict.get(record['organ'])
+            if (organ_file == record['file']) and (organ_file != whole_body_model) and \
+                    (record['whole_body'] == whole_body_model) and \
+                    (record['whole_body_stamp'] == whole_body_stamp) and \
+                    (record['file_stamp'] == file_stamp(organ_file)) and \
+                    (record.get('fit_settings') == self._get_organ_fit_settings(record['organ'])) and \
+                    (record.get('preview', False) == self._config['preview']) and \
+                    os.path.isfile(record['output']):
+                reuse_outputs[organ_file] = record['output']
+        return reuse_outputs
+
+    def _update_organ_records(self):
+        """
+        Record the inputs and output of each organ inserted in the last execution, replacing previous records.
+        """
+        whole_body_stamp = file_stamp(self._whole_body_model)
+        organ_records = []
+        for organ, organ_file in self._organ_file_dict.items():
+            output_file = self._organ_inserter.get_output_file_for(organ_file)
+            if (organ_file != self._whole_body_model) and output_file:
+                organ_records.append({
+                    'organ': organ,
+                    'file': organ_file,
+                    'file_stamp': file_stamp(organ_file),
+                    'whole_body': self._whole_body_model,
+                    'whole_body_stamp': whole_body_stamp,
+                    'fit_settings': self._get_organ_fit_settings(organ),
+                    'preview': self._config['preview'],
+                    'output': output_file,
+                })
+        self._config['organ_records'] = organ_records
+
+    def _get_organ_fit_settings(self, organ):
+        from mapclientplugins.organinserterstep.organfitsettings import get_fit_settings
+        return get_fit_settings(self._config['fit_settings'], self._config['organ_fit_settings'].get(organ))
+
     def get_output_file_name(self):
         return self._output_filenames
 
     def get_organ_name(self, filename):
-        organsList = ['lung', 'heart', 'brainstem', 'stomach', 'bladder']
-        filename_base = os.path.basename(filename).split('.')[0]
-        for organ_name in organsList:
-            if organ_name in filename_base.lower():
-                return organ_name
-        else:
-            return filename_base
-
-    def write_annotations(self, output_directory):
-        DOI = ["https://doi.org/10.26275/yibc-wyu2", "https://doi.org/10.26275/dqpf-gqdt",
-               "https://doi.org/10.26275/rets-qdch", "https://doi.org/10.26275/dqpf-gqdt",
-               "https://doi.org/10.26275/yum2-z4uf", "https://doi.org/10.26275/xq3h-ba2b", "colon"]
-        organ_names = ['whole-body']
-        for filename in self._input_data_files:
-            organ_names.append(self.get_organ_name(filename))
-
-        annotation_file = os.path.join(output_directory, 'organinserter_annotations.csv')
-        with open(annotation_file, 'w', newline='') as fout:
-            writer = csv.writer(fout)
-            writer.writerow(['Organ name', 'Source', 'File name', 'Transformed file name'])
-            writer.writerow([organ_names[0], DOI[0], 'whole_body.exf', 'whole_body.exf'])
-            for c, filename in enumerate(self._input_data_files):
-                filenamebase = os.path.basename(filename)
-                writer.writerow([organ_names[c + 1], DOI[c + 1], filenamebase,
-                                 filenamebase.split('.')[0] + '_transfromed_fit1.exf'])
-
-    def add_organ_group(self, filename):
-        context = Context('organGroup')
-        region = context.createRegion()
-        region.readFile(filename)
-        field_module = region.getFieldmodule()
-        mesh = field_module.findMeshByDimension(3)
-        with ChangeManager(field_module):
-            field_group = field_module.createFieldGroup()
-            organ_name = self.get_organ_name(filename)
-            field_group.setName(organ_name)
-            field_group.setSubelementHandlingMode(field_group.SUBELEMENT_HANDLING_MODE_FULL)
-            mesh_group = field_group.createMeshGroup(mesh)
-            is_organ = field_module.createFieldConstant(1)
-            mesh_group.addElementsConditional(is_organ)
-            sir = region.createStreaminformationRegion()
-            srm = sir.createStreamresourceMemory()
-            sir.setResourceGroupName(srm, organ_name)
-            # sir.setResourceFieldNames(srm, fieldNames)
-            region.write(sir)
-            region.writeFile(filename)
+        from mapclientplugins.organinserterstep.organregistry import get_organ_registry
+        return get_organ_registry().get_organ_name(filename)
 
 
     def setPortData(self, index, dataIn):
@@ -190,6 +248,7 @@ class OrganInserterStep(WorkflowStepMountPoint):
         then set:
             self._configured = True
         """
+        from mapclientplugins.organinserterstep.configuredialog import ConfigureDialog
         dlg = ConfigureDialog(self._main_window)
         dlg.identifierOccursCount = self._identifierOccursCount
         dlg.setConfig(self._config)
@@ -197,7 +256,8 @@ class OrganInserterStep(WorkflowStepMountPoint):
         dlg.setModal(True)
 
         if dlg.exec_():
-            self._config = dlg.getConfig()
+            # keep organ records from previous executions
+            self._config.update(dlg.getConfig())
 
         self._configured = dlg.validate()
         self._configuredObserver()
@@ -230,6 +290,7 @@ class OrganInserterStep(WorkflowStepMountPoint):
         """
         self._config.update(json.loads(string))
 
+        from mapclientplugins.organinserterstep.configuredialog import ConfigureDialog
         d = ConfigureDialog()
         d.identifierOccursCount = self._identifierOccursCount
         d.setConfig(self._config)
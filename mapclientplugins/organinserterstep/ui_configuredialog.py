@@ -15,15 +15,15 @@ from PySide6.QtGui import (QBrush, QColor, QConicalGradient, QCursor,
     QFont, QFontDatabase, QGradient, QIcon,
     QImage, QKeySequence, QLinearGradient, QPainter,
     QPalette, QPixmap, QRadialGradient, QTransform)
-from PySide6.QtWidgets import (QAbstractButton, QApplication, QDialog, QDialogButtonBox,
-    QFormLayout, QGridLayout, QGroupBox, QLabel,
-    QLineEdit, QSizePolicy, QWidget)
+from PySide6.QtWidgets import (QAbstractButton, QApplication, QCheckBox, QComboBox, QDialog, QDialogButtonBox,
+    QDoubleSpinBox, QFormLayout, QGridLayout, QGroupBox, QLabel,
+    QLineEdit, QSizePolicy, QSpinBox, QWidget)
 
 class Ui_ConfigureDialog(object):
     def setupUi(self, ConfigureDialog):
         if not ConfigureDialog.objectName():
             ConfigureDialog.setObjectName(u"ConfigureDialog")
-        ConfigureDialog.resize(418, 303)
+        ConfigureDialog.resize(418, 503)
         self.gridLayout = QGridLayout(ConfigureDialog)
         self.gridLayout.setObjectName(u"gridLayout")
         self.configGroupBox = QGroupBox(ConfigureDialog)
@@ -40,15 +40,165 @@ class Ui_ConfigureDialog(object):
 
         self.formLayout.setWidget(0, QFormLayout.FieldRole, self.lineEdit0)
 
+        self.label1 = QLabel(self.configGroupBox)
+        self.label1.setObjectName(u"label1")
+
+        self.formLayout.setWidget(1, QFormLayout.LabelRole, self.label1)
+
+        self.spinBoxWorkers = QSpinBox(self.configGroupBox)
+        self.spinBoxWorkers.setObjectName(u"spinBoxWorkers")
+        self.spinBoxWorkers.setMinimum(1)
+        self.spinBoxWorkers.setMaximum(64)
+
+        self.formLayout.setWidget(1, QFormLayout.FieldRole, self.spinBoxWorkers)
+
+        self.checkBoxForceRefit = QCheckBox(self.configGroupBox)
+        self.checkBoxForceRefit.setObjectName(u"checkBoxForceRefit")
+
+        self.formLayout.setWidget(2, QFormLayout.FieldRole, self.checkBoxForceRefit)
+
+        self.checkBoxCombinedOutput = QCheckBox(self.configGroupBox)
+        self.checkBoxCombinedOutput.setObjectName(u"checkBoxCombinedOutput")
+
+        self.formLayout.setWidget(3, QFormLayout.FieldRole, self.checkBoxCombinedOutput)
+
+        self.checkBoxPreview = QCheckBox(self.configGroupBox)
+        self.checkBoxPreview.setObjectName(u"checkBoxPreview")
+
+        self.formLayout.setWidget(4, QFormLayout.FieldRole, self.checkBoxPreview)
+
+        self.checkBoxLowMemory = QCheckBox(self.configGroupBox)
+        self.checkBoxLowMemory.setObjectName(u"checkBoxLowMemory")
+
+        self.formLayout.setWidget(5, QFormLayout.FieldRole, self.checkBoxLowMemory)
+
 
         self.gridLayout.addWidget(self.configGroupBox, 0, 0, 1, 1)
 
+        self.fitGroupBox = QGroupBox(ConfigureDialog)
+        self.fitGroupBox.setObjectName(u"fitGroupBox")
+        self.formLayoutFit = QFormLayout(self.fitGroupBox)
+        self.formLayoutFit.setObjectName(u"formLayoutFit")
+        self.labelOrgan = QLabel(self.fitGroupBox)
+        self.labelOrgan.setObjectName(u"labelOrgan")
+
+        self.formLayoutFit.setWidget(0, QFormLayout.LabelRole, self.labelOrgan)
+
+        self.comboBoxOrgan = QComboBox(self.fitGroupBox)
+        self.comboBoxOrgan.setObjectName(u"comboBoxOrgan")
+        self.comboBoxOrgan.setEditable(True)
+
+        self.formLayoutFit.setWidget(0, QFormLayout.FieldRole, self.comboBoxOrgan)
+
+        self.checkBoxUseDefault = QCheckBox(self.fitGroupBox)
+        self.checkBoxUseDefault.setObjectName(u"checkBoxUseDefault")
+
+        self.formLayoutFit.setWidget(1, QFormLayout.FieldRole, self.checkBoxUseDefault)
+
+        self.checkBoxFit = QCheckBox(self.fitGroupBox)
+        self.checkBoxFit.setObjectName(u"checkBoxFit")
+
+        self.formLayoutFit.setWidget(2, QFormLayout.FieldRole, self.checkBoxFit)
+
+        self.labelStrainPenalty = QLabel(self.fitGroupBox)
+        self.labelStrainPenalty.setObjectName(u"labelStrainPenalty")
+
+        self.formLayoutFit.setWidget(3, QFormLayout.LabelRole, self.labelStrainPenalty)
+
+        self.doubleSpinBoxStrainPenalty = QDoubleSpinBox(self.fitGroupBox)
+        self.doubleSpinBoxStrainPenalty.setObjectName(u"doubleSpinBoxStrainPenalty")
+        self.doubleSpinBoxStrainPenalty.setDecimals(6)
+        self.doubleSpinBoxStrainPenalty.setMaximum(1000000.000000000000000)
+
+        self.formLayoutFit.setWidget(3, QFormLayout.FieldRole, self.doubleSpinBoxStrainPenalty)
+
+        self.labelCurvaturePenalty = QLabel(self.fitGroupBox)
+        self.labelCurvaturePenalty.setObjectName(u"labelCurvaturePenalty")
+
+        self.formLayoutFit.setWidget(4, QFormLayout.LabelRole, self.labelCurvaturePenalty)
+
+        self.doubleSpinBoxCurvaturePenalty = QDoubleSpinBox(self.fitGroupBox)
+        self.doubleSpinBoxCurvaturePenalty.setObjectName(u"doubleSpinBoxCurvaturePenalty")
+        self.doubleSpinBoxCurvaturePenalty.setDecimals(3)
+        self.doubleSpinBoxCurvaturePenalty.setMaximum(1000000000.000000000000000)
+
+        self.formLayoutFit.setWidget(4, QFormLayout.FieldRole, self.doubleSpinBoxCurvaturePenalty)
+
+        self.labelDataWeight = QLabel(self.fitGroupBox)
+        self.labelDataWeight.setObjectName(u"labelDataWeight")
+
+        self.formLayoutFit.setWidget(5, QFormLayout.LabelRole, self.labelDataWeight)
+
+        self.doubleSpinBoxDataWeight = QDoubleSpinBox(self.fitGroupBox)
+        self.doubleSpinBoxDataWeight.setObjectName(u"doubleSpinBoxDataWeight")
+        self.doubleSpinBoxDataWeight.setDecimals(3)
+        self.doubleSpinBoxDataWeight.setMaximum(1000000000.000000000000000)
+
+        self.formLayoutFit.setWidget(5, QFormLayout.FieldRole, self.doubleSpinBoxDataWeight)
+
+        self.labelIterations = QLabel(self.fitGroupBox)
+        self.labelIterations.setObjectName(u"labelIterations")
+
+        self.formLayoutFit.setWidget(6, QFormLayout.LabelRole, self.labelIterations)
+
+        self.spinBoxIterations = QSpinBox(self.fitGroupBox)
+        self.spinBoxIterations.setObjectName(u"spinBoxIterations")
+        self.spinBoxIterations.setMinimum(1)
+        self.spinBoxIterations.setMaximum(100)
+
+        self.formLayoutFit.setWidget(6, QFormLayout.FieldRole, self.spinBoxIterations)
+
+        self.labelLevels = QLabel(self.fitGroupBox)
+        self.labelLevels.setObjectName(u"labelLevels")
+
+        self.formLayoutFit.setWidget(7, QFormLayout.LabelRole, self.labelLevels)
+
+        self.spinBoxLevels = QSpinBox(self.fitGroupBox)
+        self.spinBoxLevels.setObjectName(u"spinBoxLevels")
+        self.spinBoxLevels.setMinimum(1)
+        self.spinBoxLevels.setMaximum(10)
+
+        self.formLayoutFit.setWidget(7, QFormLayout.FieldRole, self.spinBoxLevels)
+
+        self.labelLevelIterations = QLabel(self.fitGroupBox)
+        self.labelLevelIterations.setObjectName(u"labelLevelIterations")
+
+        self.formLayoutFit.setWidget(8, QFormLayout.LabelRole, self.labelLevelIterations)
+
+        self.spinBoxLevelIterations = QSpinBox(self.fitGroupBox)
+        self.spinBoxLevelIterations.setObjectName(u"spinBoxLevelIterations")
+        self.spinBoxLevelIterations.setMinimum(1)
+        self.spinBoxLevelIterations.setMaximum(100)
+
+        self.formLayoutFit.setWidget(8, QFormLayout.FieldRole, self.spinBoxLevelIterations)
+
+        self.labelTolerance = QLabel(self.fitGroupBox)
+        self.labelTolerance.setObjectName(u"labelTolerance")
+
+        self.formLayoutFit.setWidget(9, QFormLayout.LabelRole, self.labelTolerance)
+
+        self.doubleSpinBoxTolerance = QDoubleSpinBox(self.fitGroupBox)
+        self.doubleSpinBoxTolerance.setObjectName(u"doubleSpinBoxTolerance")
+        self.doubleSpinBoxTolerance.setDecimals(6)
+        self.doubleSpinBoxTolerance.setMaximum(1.000000000000000)
+        self.doubleSpinBoxTolerance.setSingleStep(0.001000000000000)
+
+        self.formLayoutFit.setWidget(9, QFormLayout.FieldRole, self.doubleSpinBoxTolerance)
+
+        self.checkBoxWarmStart = QCheckBox(self.fitGroupBox)
+        self.checkBoxWarmStart.setObjectName(u"checkBoxWarmStart")
+
+        self.formLayoutFit.setWidget(10, QFormLayout.FieldRole, self.checkBoxWarmStart)
+
+
+        self.gridLayout.addWidget(self.fitGroupBox, 1, 0, 1, 1)
+
         self.buttonBox = QDialogButtonBox(ConfigureDialog)
         self.buttonBox.setObjectName(u"buttonBox")
         self.buttonBox.setOrientation(Qt.Horizontal)
         self.buttonBox.setStandardButtons(QDialogButtonBox.Cancel|QDialogButtonBox.Ok)
 
-        self.gridLayout.addWidget(self.buttonBox, 1, 0, 1, 1)
+        self.gridLayout.addWidget(self.buttonBox, 2, 0, 1, 1)
 
 
         self.retranslateUi(ConfigureDialog)
@@ -62,5 +212,58 @@ class Ui_ConfigureDialog(object):
         ConfigureDialog.setWindowTitle(QCoreApplication.translate("ConfigureDialog", u"Configure Step", None))
         self.configGroupBox.setTitle("")
         self.label0.setText(QCoreApplication.translate("ConfigureDialog", u"identifier:  ", None))
+        self.label1.setText(QCoreApplication.translate("ConfigureDialog", u"Workers:  ", None))
+#if QT_CONFIG(tooltip)
+        self.spinBoxWorkers.setToolTip(QCoreApplication.translate("ConfigureDialog", u"Number of processes to transform organs in parallel.", None))
+#endif // QT_CONFIG(tooltip)
+#if QT_CONFIG(tooltip)
+        self.checkBoxForceRefit.setToolTip(QCoreApplication.translate("ConfigureDialog", u"Refit all organs instead of reusing unchanged results from the cache.", None))
+#endif // QT_CONFIG(tooltip)
+        self.checkBoxForceRefit.setText(QCoreApplication.translate("ConfigureDialog", u"Force refit", None))
+#if QT_CONFIG(tooltip)
+        self.checkBoxCombinedOutput.setToolTip(QCoreApplication.translate("ConfigureDialog", u"Also write the whole body and all transformed organs to one file, with each organ in its own region.", None))
+#endif // QT_CONFIG(tooltip)
+        self.checkBoxCombinedOutput.setText(QCoreApplication.translate("ConfigureDialog", u"Combined output", None))
+#if QT_CONFIG(tooltip)
+        self.checkBoxPreview.setToolTip(QCoreApplication.translate("ConfigureDialog", u"Only align organs to the markers for a quick preview, writing each organ's transformation to a JSON file.", None))
+#endif // QT_CONFIG(tooltip)
+        self.checkBoxPreview.setText(QCoreApplication.translate("ConfigureDialog", u"Preview (align only)", None))
+#if QT_CONFIG(tooltip)
+        self.checkBoxLowMemory.setToolTip(QCoreApplication.translate("ConfigureDialog", u"Transform each organ in its own process, releasing its memory when done, and report peak memory per organ.", None))
+#endif // QT_CONFIG(tooltip)
+        self.checkBoxLowMemory.setText(QCoreApplication.translate("ConfigureDialog", u"Low memory", None))
+        self.fitGroupBox.setTitle(QCoreApplication.translate("ConfigureDialog", u"Fit settings", None))
+        self.labelOrgan.setText(QCoreApplication.translate("ConfigureDialog", u"Organ:  ", None))
+#if QT_CONFIG(tooltip)
+        self.comboBoxOrgan.setToolTip(QCoreApplication.translate("ConfigureDialog", u"Organ to edit fit settings for; type a name to add another organ.", None))
+#endif // QT_CONFIG(tooltip)
+#if QT_CONFIG(tooltip)
+        self.checkBoxUseDefault.setToolTip(QCoreApplication.translate("ConfigureDialog", u"Use the default fit settings for this organ.", None))
+#endif // QT_CONFIG(tooltip)
+        self.checkBoxUseDefault.setText(QCoreApplication.translate("ConfigureDialog", u"Use default settings", None))
+#if QT_CONFIG(tooltip)
+        self.checkBoxFit.setToolTip(QCoreApplication.translate("ConfigureDialog", u"Fit after aligning to the markers; if not checked the organ is only aligned.", None))
+#endif // QT_CONFIG(tooltip)
+        self.checkBoxFit.setText(QCoreApplication.translate("ConfigureDialog", u"Fit after aligning to markers", None))
+        self.labelStrainPenalty.setText(QCoreApplication.translate("ConfigureDialog", u"Strain penalty:  ", None))
+        self.labelCurvaturePenalty.setText(QCoreApplication.translate("ConfigureDialog", u"Curvature penalty:  ", None))
+        self.labelDataWeight.setText(QCoreApplication.translate("ConfigureDialog", u"Data weight:  ", None))
+        self.labelIterations.setText(QCoreApplication.translate("ConfigureDialog", u"Iterations:  ", None))
+        self.labelLevels.setText(QCoreApplication.translate("ConfigureDialog", u"Levels:  ", None))
+#if QT_CONFIG(tooltip)
+        self.spinBoxLevels.setToolTip(QCoreApplication.translate("ConfigureDialog", u"Number of fit levels. Levels before the last are stiffer pre-fits of the markers, which can help organs far from them converge, at the cost of extra iterations.", None))
+#endif // QT_CONFIG(tooltip)
+        self.labelLevelIterations.setText(QCoreApplication.translate("ConfigureDialog", u"Level iterations:  ", None))
+#if QT_CONFIG(tooltip)
+        self.spinBoxLevelIterations.setToolTip(QCoreApplication.translate("ConfigureDialog", u"Number of fit iterations on each pre-fit level before the last.", None))
+#endif // QT_CONFIG(tooltip)
+        self.labelTolerance.setText(QCoreApplication.translate("ConfigureDialog", u"Tolerance:  ", None))
+#if QT_CONFIG(tooltip)
+        self.doubleSpinBoxTolerance.setToolTip(QCoreApplication.translate("ConfigureDialog", u"Stop iterating once the relative decrease in RMS error is below this; 0 to run all iterations.", None))
+#endif // QT_CONFIG(tooltip)
+#if QT_CONFIG(tooltip)
+        self.checkBoxWarmStart.setToolTip(QCoreApplication.translate("ConfigureDialog", u"Start the fit from the organ's last fit in an earlier execution, aligned to these markers, and only fit the last level.", None))
+#endif // QT_CONFIG(tooltip)
+        self.checkBoxWarmStart.setText(QCoreApplication.translate("ConfigureDialog", u"Warm start from previous fit", None))
     # retranslateUi
 
@@ -15,9 +15,10 @@ from PySide6.QtGui import (QBrush, QColor, QConicalGradient, QCursor,
     QFont, QFontDatabase, QGradient, QIcon,
     QImage, QKeySequence, QLinearGradient, QPainter,
     QPalette, QPixmap, QRadialGradient, QTransform)
-from PySide6.QtWidgets import (QApplication, QHBoxLayout, QHeaderView, QPushButton,
-    QSizePolicy, QSpacerItem, QTableWidget, QTableWidgetItem,
-    QVBoxLayout, QWidget)
+from PySide6.QtWidgets import (QAbstractItemView, QApplication, QComboBox, QHBoxLayout,
+    QHeaderView, QLabel, QLineEdit, QPushButton,
+    QSizePolicy, QSpacerItem, QTableView, QVBoxLayout,
+    QWidget)
 
 class Ui_OrganInserterWidget(object):
     def setupUi(self, OrganInserterWidget):
@@ -31,17 +32,55 @@ class Ui_OrganInserterWidget(object):
         OrganInserterWidget.setSizePolicy(sizePolicy)
         self.verticalLayout = QVBoxLayout(OrganInserterWidget)
         self.verticalLayout.setObjectName(u"verticalLayout")
-        self.tableViewOrganFiles = QTableWidget(OrganInserterWidget)
+        self.horizontalLayout = QHBoxLayout()
+        self.horizontalLayout.setObjectName(u"horizontalLayout")
+        self.lineEditFilter = QLineEdit(OrganInserterWidget)
+        self.lineEditFilter.setObjectName(u"lineEditFilter")
+        self.lineEditFilter.setClearButtonEnabled(True)
+
+        self.horizontalLayout.addWidget(self.lineEditFilter)
+
+        self.comboBoxOrgan = QComboBox(OrganInserterWidget)
+        self.comboBoxOrgan.setObjectName(u"comboBoxOrgan")
+
+        self.horizontalLayout.addWidget(self.comboBoxOrgan)
+
+        self.pushButtonAssign = QPushButton(OrganInserterWidget)
+        self.pushButtonAssign.setObjectName(u"pushButtonAssign")
+
+        self.horizontalLayout.addWidget(self.pushButtonAssign)
+
+        self.pushButtonClassify = QPushButton(OrganInserterWidget)
+        self.pushButtonClassify.setObjectName(u"pushButtonClassify")
+
+        self.horizontalLayout.addWidget(self.pushButtonClassify)
+
+
+        self.verticalLayout.addLayout(self.horizontalLayout)
+
+        self.tableViewOrganFiles = QTableView(OrganInserterWidget)
         self.tableViewOrganFiles.setObjectName(u"tableViewOrganFiles")
+        self.tableViewOrganFiles.setSelectionBehavior(QAbstractItemView.SelectRows)
 
         self.verticalLayout.addWidget(self.tableViewOrganFiles)
 
         self.horizontalLayout_2 = QHBoxLayout()
         self.horizontalLayout_2.setObjectName(u"horizontalLayout_2")
+        self.labelProgress = QLabel(OrganInserterWidget)
+        self.labelProgress.setObjectName(u"labelProgress")
+
+        self.horizontalLayout_2.addWidget(self.labelProgress)
+
         self.horizontalSpacer = QSpacerItem(40, 20, QSizePolicy.Expanding, QSizePolicy.Minimum)
 
         self.horizontalLayout_2.addItem(self.horizontalSpacer)
 
+        self.pushButtonCancel = QPushButton(OrganInserterWidget)
+        self.pushButtonCancel.setObjectName(u"pushButtonCancel")
+        self.pushButtonCancel.setEnabled(False)
+
+        self.horizontalLayout_2.addWidget(self.pushButtonCancel)
+
         self.pushButtonDone = QPushButton(OrganInserterWidget)
         self.pushButtonDone.setObjectName(u"pushButtonDone")
 
@@ -58,6 +97,17 @@ class Ui_OrganInserterWidget(object):
 
     def retranslateUi(self, OrganInserterWidget):
         OrganInserterWidget.setWindowTitle(QCoreApplication.translate("OrganInserterWidget", u"Organ Inserter", None))
+        self.lineEditFilter.setPlaceholderText(QCoreApplication.translate("OrganInserterWidget", u"Filter files", None))
+#if QT_CONFIG(tooltip)
+        self.pushButtonAssign.setToolTip(QCoreApplication.translate("OrganInserterWidget", u"Set the organ of the selected files, or all files shown if none are selected", None))
+#endif // QT_CONFIG(tooltip)
+        self.pushButtonAssign.setText(QCoreApplication.translate("OrganInserterWidget", u"Assign", None))
+#if QT_CONFIG(tooltip)
+        self.pushButtonClassify.setToolTip(QCoreApplication.translate("OrganInserterWidget", u"Classify the selected files, or all files shown if none are selected, from their names or groups", None))
+#endif // QT_CONFIG(tooltip)
+        self.pushButtonClassify.setText(QCoreApplication.translate("OrganInserterWidget", u"Classify", None))
+        self.labelProgress.setText("")
+        self.pushButtonCancel.setText(QCoreApplication.translate("OrganInserterWidget", u"Cancel", None))
         self.pushButtonDone.setText(QCoreApplication.translate("OrganInserterWidget", u"Done", None))
     # retranslateUi
 
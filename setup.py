@@ -51,6 +51,10 @@ setup(
     packages=find_packages(exclude=['ez_setup',]),
     namespace_packages=['mapclientplugins'],
     include_package_data=True,
+    package_data={'mapclientplugins.organinserterstep': ['organs.json']},
     zip_safe=False,
     install_requires=requires,
+    entry_points={
+        'console_scripts': ['organinserter = mapclientplugins.organinserterstep.cli:main'],
+    },
 )
@@ -0,0 +1,15 @@
+import pytest
+
+pytest.importorskip('mapclient')
+
+from benchmarks.benchmark_import_time import measure_import  # noqa: E402
+
+# generous budget so the test is not flaky on slow machines; benchmark_import_time.py checks the real budget
+IMPORT_TIME_BUDGET = 0.5
+
+
+def test_import_time():
+    result = measure_import()
+    assert result['registered']
+    assert result['deferred_loaded'] == []
+    assert result['elapsed'] < IMPORT_TIME_BUDGET
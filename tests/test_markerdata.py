@@ -0,0 +1,63 @@
+import pickle
+
+import pytest
+
+from mapclientplugins.organinserterstep.organinsertermodel import MarkerData
+
+
+def make_marker_data():
+    return MarkerData([3, 7, 9, 12],
+                      [0.0, 1.0, 2.0, 3.5, -4.25, 5.0, 1e-12, 6.0, 7.0, 8.0, 9.0, 1e12],
+                      ['apex of heart', 'Left lung ', 'apex of heart', 'café'],
+                      source_filename='whole-body.exf')
+
+
+def assert_marker_data_equal(marker_data, expected):
+    assert list(marker_data.get_identifiers()) == list(expected.get_identifiers())
+    assert list(marker_data.get_coordinates()) == list(expected.get_coordinates())
+    assert marker_data.get_names() == expected.get_names()
+    assert marker_data.get_source_filename() == expected.get_source_filename()
+
+
+def test_binary_round_trip(tmp_path):
+    marker_data = make_marker_data()
+    filename = str(tmp_path / 'markers.bin')
+    marker_data.write_binary(filename)
+    assert_marker_data_equal(MarkerData.read_binary(filename), marker_data)
+
+
+def test_binary_round_trip_empty(tmp_path):
+    marker_data = MarkerData()
+    filename = str(tmp_path / 'markers.bin')
+    marker_data.write_binary(filename)
+    assert len(MarkerData.read_binary(filename)) == 0
+
+
+def test_read_binary_rejects_other_files(tmp_path):
+    filename = tmp_path / 'markers.bin'
+    filename.write_bytes(b'EX Version: 3\n')
+    with pytest.raises(AssertionError):
+        MarkerData.read_binary(str(filename))
+
+
+def test_pickle():
+    marker_data = make_marker_data()
+    assert_marker_data_equal(pickle.loads(pickle.dumps(marker_data)), marker_data)
+
+
+def test_subset():
+    marker_data = make_marker_data()
+    subset = marker_data.subset(['LEFT LUNG', ' Apex of heart', 'liver'])
+    # markers with the same name are all kept, in their original order
+    assert list(subset.get_identifiers()) == [3, 7, 9]
+    assert list(subset.get_coordinates()) == [0.0, 1.0, 2.0, 3.5, -4.25, 5.0, 1e-12, 6.0, 7.0]
+    assert subset.get_names() == ['apex of heart', 'Left lung ', 'apex of heart']
+    assert subset.get_source_filename() == 'whole-body.exf'
+    assert len(marker_data.subset([])) == 0
+
+
+def test_subset_after_add():
+    marker_data = make_marker_data()
+    assert len(marker_data.subset(['liver'])) == 0
+    marker_data.add(20, [1.0, 2.0, 3.0], 'Liver')
+    assert list(marker_data.subset(['liver']).get_identifiers()) == [20]
@@ -0,0 +1,52 @@
+from cmlibs.zinc.context import Context
+from cmlibs.zinc.result import RESULT_OK
+
+from benchmarks.synthetic_scaffolds import write_organ_scaffold
+from mapclientplugins.organinserterstep.organinputscan import scan_ex_file, scan_ex_group_definition
+from mapclientplugins.organinserterstep.organinsertermodel import get_organ_group_definition
+
+
+def test_scan_ex_file(tmp_path):
+    filename = str(tmp_path / 'heart.exf')
+    write_organ_scaffold(filename, 2)
+    summary = scan_ex_file(filename)
+    assert summary['regions'] == ['/']
+    assert 'marker' in summary['groups']
+    assert summary['fields']['coordinates']['type'] == 'coordinate'
+    assert summary['fields']['coordinates']['components'] == 3
+    assert summary['elements'] == [54, 36, 8]
+
+
+def test_scan_ex_group_definition_matches_zinc(tmp_path):
+    filename = str(tmp_path / 'heart.exf')
+    write_organ_scaffold(filename, 3)
+    definition = scan_ex_group_definition(filename, 'heart')
+    assert definition is not None
+    assert definition == get_organ_group_definition(filename, 'heart')
+
+
+def test_scan_ex_group_definition_skips_ungrouped_elements(tmp_path):
+    # non-contiguous identifiers are written as ranges
+    filename = str(tmp_path / 'heart.exf')
+    write_organ_scaffold(filename, 3)
+    context = Context('test')
+    region = context.createRegion()
+    region.readFile(filename)
+    mesh = region.getFieldmodule().findMeshByDimension(3)
+    for identifier in (2, 5, 6):
+        mesh.destroyElement(mesh.findElementByIdentifier(identifier))
+    assert region.writeFile(filename) == RESULT_OK
+    definition = scan_ex_group_definition(filename, 'heart')
+    assert b'1,3..4,7..' in definition
+    assert definition == get_organ_group_definition(filename, 'heart')
+
+
+def test_scan_ex_group_definition_multiple_regions(tmp_path):
+    filename = str(tmp_path / 'organs.exf')
+    context = Context('test')
+    region = context.createRegion()
+    write_organ_scaffold(str(tmp_path / 'heart.exf'), 2)
+    child = region.createChild('heart')
+    child.readFile(str(tmp_path / 'heart.exf'))
+    assert region.writeFile(filename) == RESULT_OK
+    assert scan_ex_group_definition(filename, 'heart') is None
@@ -0,0 +1,106 @@
+import os
+
+import pytest
+
+from mapclientplugins.organinserterstep.organinserterjournal import JOURNAL_FILENAME, TEMPORARY_SUFFIX, \
+    OrganInserterJournal
+from mapclientplugins.organinserterstep.organinsertermodel import MarkerData
+
+FIT_SETTINGS = {'fit': True, 'iterations': 1}
+
+
+@pytest.fixture
+def run(tmp_path):
+    """
+    :return: Output directory, whole-body file and organ file of a run.
+    """
+    output_directory = tmp_path / 'output'
+    output_directory.mkdir()
+    whole_body_file = tmp_path / 'whole-body.exf'
+    whole_body_file.write_text('whole body')
+    organ_file = tmp_path / 'heart.exf'
+    organ_file.write_text('heart')
+    return str(output_directory), str(whole_body_file), str(organ_file)
+
+
+def complete_organ(journal, output_directory, organ_file, fit_settings=FIT_SETTINGS):
+    fingerprint = journal.organ_fingerprint(organ_file, 'heart', fit_settings)
+    output_file = os.path.join(output_directory, 'heart_fit.exf')
+    with open(output_file, 'w') as f:
+        f.write('fitted heart')
+    journal.record_organ(organ_file, fingerprint, ['align', 'fit'], output_file)
+    return fingerprint, output_file
+
+
+def test_resume(run):
+    output_directory, whole_body_file, organ_file = run
+    journal = OrganInserterJournal(output_directory, whole_body_file)
+    assert os.path.isfile(os.path.join(output_directory, JOURNAL_FILENAME))
+    fingerprint, output_file = complete_organ(journal, output_directory, organ_file)
+    journal = OrganInserterJournal(output_directory, whole_body_file, resume=True)
+    assert journal.organ_fingerprint(organ_file, 'heart', FIT_SETTINGS) == fingerprint
+    assert journal.get_completed_output(organ_file, fingerprint) == output_file
+
+
+def test_not_resumed(run):
+    output_directory, whole_body_file, organ_file = run
+    journal = OrganInserterJournal(output_directory, whole_body_file)
+    fingerprint, _ = complete_organ(journal, output_directory, organ_file)
+    journal = OrganInserterJournal(output_directory, whole_body_file)
+    assert journal.get_completed_output(organ_file, fingerprint) is None
+
+
+def test_resume_changed_inputs(run):
+    output_directory, whole_body_file, organ_file = run
+    journal = OrganInserterJournal(output_directory, whole_body_file)
+    fingerprint, _ = complete_organ(journal, output_directory, organ_file)
+    journal = OrganInserterJournal(output_directory, whole_body_file, resume=True)
+    assert journal.organ_fingerprint(organ_file, 'heart', dict(FIT_SETTINGS, iterations=2)) != fingerprint
+    assert journal.organ_fingerprint(organ_file, 'heart', FIT_SETTINGS, preview=True) != fingerprint
+    with open(organ_file, 'w') as f:
+        f.write('changed heart')
+    assert journal.organ_fingerprint(organ_file, 'heart', FIT_SETTINGS) != fingerprint
+    # a different whole body discards the previous journal
+    with open(whole_body_file, 'w') as f:
+        f.write('changed whole body')
+    journal = OrganInserterJournal(output_directory, whole_body_file, resume=True)
+    assert journal.get_completed_output(organ_file, fingerprint) is None
+
+
+def test_resume_changed_output(run):
+    output_directory, whole_body_file, organ_file = run
+    journal = OrganInserterJournal(output_directory, whole_body_file)
+    fingerprint, output_file = complete_organ(journal, output_directory, organ_file)
+    with open(output_file, 'a') as f:
+        f.write(' edited')
+    journal = OrganInserterJournal(output_directory, whole_body_file, resume=True)
+    assert journal.get_completed_output(organ_file, fingerprint) is None
+    os.remove(output_file)
+    assert journal.get_completed_output(organ_file, fingerprint) is None
+
+
+def test_resume_marker_data(run):
+    output_directory, whole_body_file, _ = run
+    journal = OrganInserterJournal(output_directory, whole_body_file)
+    assert not journal.has_marker_data()
+    journal.record_marker_data(MarkerData([1], [1.0, 2.0, 3.0], ['apex'], source_filename=whole_body_file))
+    journal = OrganInserterJournal(output_directory, whole_body_file, resume=True)
+    assert journal.has_marker_data()
+    marker_data = MarkerData.read_binary(journal.get_marker_data_filename())
+    assert marker_data.get_names() == ['apex']
+    os.remove(journal.get_marker_data_filename())
+    journal = OrganInserterJournal(output_directory, whole_body_file, resume=True)
+    assert not journal.has_marker_data()
+
+
+def test_remove_partial_files(run):
+    output_directory, whole_body_file, _ = run
+    journal = OrganInserterJournal(output_directory, whole_body_file)
+    output_file = os.path.join(output_directory, 'heart_fit.exf')
+    other_file = os.path.join(output_directory, 'notes' + TEMPORARY_SUFFIX)
+    for filename in (output_file + TEMPORARY_SUFFIX, other_file,
+                     journal.get_marker_data_filename() + TEMPORARY_SUFFIX):
+        with open(filename, 'w') as f:
+            f.write('partial')
+    journal.remove_partial_files([output_file])
+    assert sorted(os.listdir(output_directory)) == sorted([JOURNAL_FILENAME, os.path.basename(other_file)])
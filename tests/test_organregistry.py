@@ -0,0 +1,64 @@
+import pytest
+
+from mapclientplugins.organinserterstep.organregistry import OrganRegistry, get_organ_registry, \
+    normalize_organ_name
+
+
+@pytest.fixture
+def registry():
+    return get_organ_registry()
+
+
+def test_normalize_organ_name():
+    assert normalize_organ_name(' Urinary_Bladder ') == 'urinary bladder'
+    assert normalize_organ_name('brain--stem') == 'brain stem'
+
+
+@pytest.mark.parametrize('filename, name', [
+    ('heart.exf', 'heart'),
+    ('/data/Heart_scaffold_v2.exf', 'heart'),
+    ('lungs.exf', 'lung'),
+    ('brain-stem.exf', 'brainstem'),
+    ('Brain_Stem.exf', 'brainstem'),
+    ('urinary_bladder.exf', 'bladder'),
+    ('whole-body.exf', 'whole body'),
+    ('body.exf', 'whole body'),
+    ('liver.exf', None),
+    # only the base name before the first dot is matched
+    ('/heart/liver.heart.exf', None),
+])
+def test_match_file_name(registry, filename, name):
+    assert registry.match_file_name(filename) == name
+
+
+def test_match_group_names(registry):
+    assert registry.match_group_names(['marker', 'left lung']) is None
+    assert registry.match_group_names(['marker', 'left lung', 'Lungs', 'lung']) == 'lung'
+    assert registry.match_group_names(['Heart', 'brain stem']) is None
+    assert registry.match_group_names(['heart', 'whole_body']) == 'whole body'
+    assert registry.match_group_names([]) is None
+
+
+def test_classify_file(registry, tmp_path):
+    filename = tmp_path / 'scaffold.exf'
+    filename.write_text('EX Version: 3\nRegion: /\nGroup name: marker\nGroup name: Stomach\n')
+    assert registry.classify_file(str(filename)) == 'stomach'
+    assert registry.classify_file(str(tmp_path / 'missing.exf')) is None
+    assert registry.classify_file(str(tmp_path / 'missing_heart.exf')) == 'heart'
+
+
+def test_get_organ_name(registry):
+    assert registry.get_organ_name('/data/lungs.exf') == 'lung'
+    assert registry.get_organ_name('/data/liver.v1.exf') == 'liver'
+
+
+def test_fitted():
+    registry = OrganRegistry({
+        'whole_body': {'name': 'body'},
+        'organs': [{'name': 'heart', 'fit': True}, {'name': 'colon', 'aliases': ['large intestine'], 'fit': False}],
+    })
+    assert registry.get_organ_names() == ['heart', 'colon']
+    assert registry.get_organ_names(fit_only=True) == ['heart']
+    assert not registry.is_fitted('colon')
+    assert registry.is_fitted('liver')
+    assert registry.match_file_name('large-intestine.exf') == 'colon'